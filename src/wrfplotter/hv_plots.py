@@ -1,5 +1,10 @@
 import panel as pn
 import holoviews as hv
+import hvplot.pandas  # noqa: F401 (registers the .hvplot accessor)
+import hvplot.xarray  # noqa: F401
+import numpy as np
+import pandas as pd
+from bokeh.models import DatetimeTickFormatter
 
 try:
     import cartopy.crs as crs
@@ -8,7 +13,23 @@ try:
 except ModuleNotFoundError:
     enable_maps = False
 
-from src.wrftamer.Statistics import Statistics
+try:
+    import datashader  # noqa: F401 (used by hvplot for rasterize=True)
+
+    enable_datashader = True
+except ModuleNotFoundError:
+    enable_datashader = False
+
+from wrfplotter.statistics import calc_statistics
+from wrfplotter.load_and_prepare import (
+    DENSITY_THRESHOLD,
+    use_density,
+    calc_obs_vs_mod_density,
+    aggregate_time,
+    get_windrose_tables,
+)
+
+DOWNSAMPLE_THRESHOLD = 5000  # samples per column
 
 
 ########################################################################################################################
@@ -31,49 +52,29 @@ def create_hv_plot(infos: dict, data=None, map_data=None):
 
     if plottype == "Timeseries":
 
-        stats = Statistics(data, **infos)
+        stats = get_statistics(data, infos)
 
         size = 5
 
-        for idx, item in enumerate(data):
-            if idx == 0:
-                if var == "DIR":
-                    figure = (
-                        data[item]
-                            .dropna()
-                            .hvplot.scatter(
-                            xlim=tlim,
-                            ylim=ylim,
-                            size=size,
-                            xlabel=xlabel,
-                            ylabel=ylabel,
-                            title=title,
-                        )
-                    )
-                else:
-                    figure = (
-                        data[item]
-                            .dropna()
-                            .hvplot(xlim=tlim, ylim=ylim, xlabel=xlabel, ylabel=ylabel, title=title)
-                    )
-            else:
-                if var == "DIR":
-                    figure = figure * data[item].dropna().hvplot.scatter(
-                        xlim=tlim, ylim=ylim, size=size, xlabel=xlabel, ylabel=ylabel, title=title
-                    )
-                else:
-                    figure = figure * data[item].dropna().hvplot(
-                        xlim=tlim, ylim=ylim, xlabel=xlabel, ylabel=ylabel, title=title
-                    )
+        # a single overlay of all columns from a tidy frame. Long series are downsampled (LTTB) to the width of the
+        # plot and re-sampled in full resolution when zooming in.
+        tidy = to_tidy(data, var)
+        kwargs = dict(x=tidy.columns[0], y=var, by="data", xlim=tlim, ylim=ylim, xlabel=xlabel, ylabel=ylabel)
+        kwargs["downsample"] = get_downsample(data, infos.get("downsample", None))
+
+        if var == "DIR":
+            figure = tidy.hvplot.scatter(size=size, title=title, **kwargs)
+        else:
+            figure = tidy.hvplot.line(title=title, **kwargs)
 
         if len(data.columns) > 1:
             figure.opts(legend_position="bottom_right")
 
-        figure = pn.Column(figure, stats)
+        figure = pn.Column(figure, pn.pane.DataFrame(stats))
 
     elif plottype == 'Histogram':
 
-        stats = Statistics(data, **infos)
+        stats = get_statistics(data, infos)
 
         size = 5
         # width = 400
@@ -85,7 +86,12 @@ def create_hv_plot(infos: dict, data=None, map_data=None):
             ylabel=ylabel,
             title=title,
         )
-        figure = pn.Column(figure, stats)
+        figure = pn.Column(figure, pn.pane.DataFrame(stats))
+
+    elif plottype == "Windrose":
+        tables = get_windrose_tables(*data, wspmax=infos.get("wspmax"))  # data, see prep_windrose_data
+        figure = hv.Layout([Windrose_hvplots(tables.sel(column=col)) for col in tables.column.values]).cols(2)
+        stats = None
 
     elif plottype == "Profiles":
 
@@ -162,31 +168,41 @@ def create_hv_plot(infos: dict, data=None, map_data=None):
         mods = infos["Expvec"]
         obs = infos["Obsvec"][0]
 
-        stats = Statistics(data, **infos)
+        stats = get_statistics(data, infos)
 
         # For the plot.
         size = 5
         height, width = 500, 650
 
-        figure = hv.Curve([[0, 0], [xlim[1], xlim[1]]]).opts(color="grey")
-        for mod in mods:
-            figure = figure * data.hvplot.scatter(
-                x=obs,
-                y=mod,
-                xlim=xlim,
-                ylim=ylim,
-                size=size,
-                width=width,
-                height=height,
-                label=mod,
-                xlabel=xlabel,
-                ylabel=ylabel,
-                title=title,
-            )
-
-        figure.opts(legend_position="bottom_right")
-
-        figure = pn.Column(figure, stats)
+        quantiles = np.linspace(0.01, 0.99, 99) if infos.get("qq", False) else None
+        pairs = data[[obs] + [mod for mod in mods if mod in data.columns]]
+
+        if use_density(pairs, infos.get("density", None), infos.get("density_threshold", DENSITY_THRESHOLD)):
+            figure = Obs_vs_Mod_density(pairs, quantiles, xlim, ylim, xlabel, ylabel, height, width)
+        else:
+            figure = hv.Curve([[0, 0], [xlim[1], xlim[1]]]).opts(color="grey")
+            if quantiles is not None:
+                density = calc_obs_vs_mod_density(pairs, bins=1, lims=xlim, quantiles=quantiles)
+                for mod, (qobs, qmod) in density["qq"].items():
+                    figure = figure * hv.Curve((qobs, qmod), label=f"{mod} (quantiles)")
+            for mod in mods:
+                figure = figure * data.hvplot.scatter(
+                    x=obs,
+                    y=mod,
+                    xlim=xlim,
+                    ylim=ylim,
+                    size=size,
+                    width=width,
+                    height=height,
+                    label=mod,
+                    xlabel=xlabel,
+                    ylabel=ylabel,
+                    title=title,
+                )
+
+            figure.opts(legend_position="bottom_right")
+
+        figure = pn.Column(figure, pn.pane.DataFrame(stats))
 
     elif plottype in ["Map", "Diff Map"]:
 
@@ -198,6 +214,26 @@ def create_hv_plot(infos: dict, data=None, map_data=None):
         stats = None
 
     elif plottype == "zt-Plot":
+        # time is aggregated to the width of the plot before it is sent to the browser (zt_aggregate: mean, max or
+        # None). Mean heights are additionally rasterized by datashader, if available.
+        aggregate = infos.get("zt_aggregate", "mean")
+        width = infos.get("width", 700)
+        kwargs = dict(width=width)
+        if aggregate is not None:
+            data = aggregate_time(data, infos.get("zt_bins", None) or width, aggregate)
+
+        if data["ALT"].ndim == 1 and enable_datashader:
+            kwargs["rasterize"] = True
+        elif data["ALT"].ndim == 2:
+            # Curvilinear quadmesh (time-varying heights). Holoviews cannot broadcast datetimes, so time is passed as
+            # milliseconds since 1970 (the unit of bokeh's datetime axes).
+            def to_ms(item):
+                return np.asarray(item, dtype="datetime64[ms]").astype(float)
+
+            data = data.assign_coords(time=to_ms(data["time"].values)).transpose(..., "time")
+            tlim = (float(to_ms(tlim[0])), float(to_ms(tlim[1])))
+            kwargs["xformatter"] = DatetimeTickFormatter()
+
         figure = data.hvplot.quadmesh(
             x="time",
             y="ALT",
@@ -207,6 +243,7 @@ def create_hv_plot(infos: dict, data=None, map_data=None):
             xlim=tlim,
             ylim=ylim,
             clim=tuple(clim),
+            **kwargs,
         )
         stats = None
 
@@ -218,6 +255,110 @@ def create_hv_plot(infos: dict, data=None, map_data=None):
     return figure, stats
 
 
+def Obs_vs_Mod_density(pairs, quantiles, xlim, ylim, xlabel, ylabel, height, width):
+    """
+    Density of model against observation (the first column of pairs), one panel per model. With datashader, the
+    points are rasterized dynamically; otherwise, a 2D histogram is shown.
+    """
+
+    obs = pairs.columns[0]
+    if quantiles is not None or not enable_datashader:
+        density = calc_obs_vs_mod_density(pairs, lims=xlim, quantiles=quantiles)
+
+    panels = []
+    for mod in pairs.columns[1:]:
+        if enable_datashader:
+            panel = pairs.hvplot.scatter(x=obs, y=mod, rasterize=True, cnorm="log", xlim=xlim, ylim=ylim)
+        else:
+            edges = density["edges"]
+            counts = np.where(density["counts"][mod] > 0, density["counts"][mod], np.nan)
+            panel = hv.QuadMesh((edges, edges, counts.T), kdims=[obs, mod]).opts(logz=True, colorbar=True)
+
+        panel = panel * hv.Curve([[xlim[0], xlim[0]], [xlim[1], xlim[1]]]).opts(color="grey")
+        if quantiles is not None and mod in density["qq"]:
+            panel = panel * hv.Scatter(density["qq"][mod], label="quantiles").opts(color="red")
+
+        panel = panel.opts(
+            title=mod, xlabel=xlabel, ylabel=ylabel, xlim=tuple(xlim), ylim=tuple(ylim), height=height, width=width
+        )
+        panels.append(panel)
+
+    return hv.Layout(panels).cols(2)
+
+
+def Windrose_hvplots(table, height=400, width=400):
+    """
+    A wind rose as a radial heatmap of a frequency table (see calc_windrose_tables): the sectors run clockwise from
+    north, the speed bins outwards.
+    """
+
+    nsector = table.sizes["sector"]
+    # holoviews draws the categories counterclockwise, starting with north
+    order = np.roll(np.arange(nsector)[::-1], 1)
+    sectors = [f"{item:g}" for item in table.sector.values[order]]
+    speeds = [f"{item:g}" for item in table.speed.values]
+
+    values = [(sectors[i], speeds[j], table.values[j, order[i]]) for i in range(nsector) for j in range(len(speeds))]
+
+    return hv.HeatMap(values, kdims=["sector", "speed"], vdims=["frequency"]).opts(
+        radial=True,
+        start_angle=np.pi / 2 - np.pi / nsector,
+        xmarks=8,
+        ymarks=len(speeds),
+        yticks=None,
+        cmap="hot_r",
+        colorbar=True,
+        tools=["hover"],
+        title=str(table.column.values),
+        height=height,
+        width=width,
+    )
+
+
+def to_tidy(data: pd.DataFrame, var: str) -> pd.DataFrame:
+    """
+    A long frame (time, data, var) of all columns without missing values. data is categorical in the order of the
+    columns, which keeps the order of the legend and the colors.
+    """
+
+    tidy = data.rename_axis(data.index.name or "time").melt(ignore_index=False, var_name="data", value_name=var)
+    tidy = tidy.dropna(subset=[var]).reset_index()
+    tidy["data"] = pd.Categorical(tidy["data"], categories=list(data.columns))
+
+    return tidy
+
+
+def get_downsample(data: pd.DataFrame, downsample=None, threshold=DOWNSAMPLE_THRESHOLD):
+    """
+    The downsampling algorithm of a time series plot (see holoviews' downsample1d) or False. Automatic
+    (downsample=None), if a column is longer than threshold. True means lttb.
+    """
+
+    if downsample is None:
+        downsample = len(data) > threshold
+    if downsample is True:
+        downsample = "lttb"
+
+    return downsample
+
+
+def get_statistics(data, infos: dict):
+    """
+    Statistics of all experiments against the first observation (see wrfplotter.statistics), rounded for display.
+    A table that was already calculated can be passed as infos["statistics"].
+    """
+
+    if infos.get("statistics", None) is not None:
+        return infos["statistics"]
+
+    obsvec = [item for item in infos.get("Obsvec", []) if item in data.columns]
+    expvec = [item for item in infos.get("Expvec", []) if item in data.columns]
+    if len(obsvec) == 0 or len(expvec) == 0:
+        return pd.DataFrame()
+
+    return calc_statistics(data, obs=obsvec[0], models=expvec, var=infos.get("var", None)).round(2)
+
+
 def Map_hvplots(map_data, **infos):
     if not enable_maps:
         print('You must install Cartopy to use this feature.')
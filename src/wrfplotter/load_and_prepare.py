@@ -1,7 +1,16 @@
 import datetime as dt
+import hashlib
+import os
+import threading
+import warnings
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import Mapping
 import xarray as xr
 import pandas as pd
 import numpy as np
+from wrfplotter.variable_index import get_device, get_variable_index
 
 
 ########################################################################################################################
@@ -9,12 +18,222 @@ import numpy as np
 ########################################################################################################################
 
 
+class TslistCache:
+    """
+    Process-wide, size-bounded LRU cache of opened (lazy) tslist datasets and the location lists of the experiments.
+
+    Entries are keyed on (project, experiment, dom, name of the file, mtime of the file), so a file that is
+    rewritten (i.e. by a ppp step) is opened again. The memory footprint of an entry is the size of the dataset
+    once loaded. The least recently used entries are closed and evicted if the sum exceeds maxbytes.
+    """
+
+    def __init__(self, maxbytes=2 * 1024 ** 3):
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self) -> int:
+        return sum(item[0].nbytes for item in self._entries.values())
+
+    def get(self, key: tuple):
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: tuple, data: xr.Dataset, list_of_locs: list):
+        with self._lock:
+            # An older version of the same file is outdated.
+            for old_key in [item for item in self._entries if item[:-1] == key[:-1]]:
+                self._entries.pop(old_key)[0].close()
+
+            self._entries[key] = (data, list_of_locs)
+
+            while len(self._entries) > 1 and self.nbytes > self.maxbytes:
+                _, (old_data, _) = self._entries.popitem(last=False)
+                old_data.close()
+
+    def clear(self):
+        with self._lock:
+            for data, _ in self._entries.values():
+                data.close()
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "nbytes": self.nbytes}
+
+
+tslist_cache = TslistCache()
+
+
+def _get_project(proj_name):
+    from wrftamer import project
+
+    return project(proj_name)
+
+
+class StationView(Mapping):
+    """
+    Read-only, dict-like view of a tslist dataset by station. view[loc] selects a single station lazily, without a
+    copy. The whole dataset (i.e. for vectorized operations over all stations) is view.data.
+    """
+
+    def __init__(self, data: xr.Dataset):
+        self.data = data
+        self._index = {str(name): idx for idx, name in enumerate(data["station_name"].values)}
+
+    def __getitem__(self, loc: str) -> xr.Dataset:
+        return self.data.isel(station_name=self._index[loc])
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+
+def open_tslist(proj_name, exp_name: str, dom: str, name: str):
+    """
+    Opens the file <workdir>/out/<name>_<dom>.nc of an experiment lazily, using tslist_cache.
+    The dataset is shared between all callers and must not be closed or changed in place. The list of locations is
+    cached with the dataset, so it is read again if the file changes.
+
+    Args:
+        proj_name: name of the project
+        exp_name: name of the experiment
+        dom: domain, i.e. d01
+        name: i.e. Ave10Min_tslist or raw_tslist
+
+    Returns: the dataset (None, if the file does not exist), the list of locations and the filename
+
+    """
+
+    proj = _get_project(proj_name)
+    file2load = proj.get_workdir(exp_name) / f"out/{name}_{dom}.nc"
+
+    if not file2load.is_file():
+        return None, proj.exp_list_tslocs(exp_name, verbose=False), file2load
+
+    key = (proj_name, exp_name, dom, name, file2load.stat().st_mtime_ns)
+    entry = tslist_cache.get(key)
+    if entry is None:
+        entry = (xr.open_dataset(file2load, chunks={}), proj.exp_list_tslocs(exp_name, verbose=False))
+        tslist_cache.put(key, *entry)
+
+    return entry[0], entry[1], file2load
+
+
+def _file_signature(filename) -> str:
+    stat = filename.stat()
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def calc_averaged_tslist(raw: xr.Dataset, ave_window: int) -> xr.Dataset:
+    """
+    Averages a tslist over ave_window minutes. Like the Ave<N>Min tslists written by ppp, the intervals are
+    (t - ave_window, t] and labeled with their end t. For variables starting with DIR, the circular mean is
+    calculated. raw may hold dask arrays; then nothing is computed here and the averages are computed chunk by
+    chunk when the result is written.
+    """
+
+    resample = {"time": f"{int(ave_window)}min", "label": "right", "closed": "right"}
+
+    names = [
+        name for name, item in raw.data_vars.items() if "time" in item.dims and np.issubdtype(item.dtype, np.number)
+    ]
+    directions = [name for name in names if str(name).startswith("DIR")]
+
+    data = raw[[name for name in names if name not in directions]].resample(**resample).mean(keep_attrs=True)
+    for name in directions:
+        rad = np.deg2rad(raw[name])
+        ssum = np.sin(rad).resample(**resample).mean()
+        csum = np.cos(rad).resample(**resample).mean()
+        data[name] = np.mod(np.rad2deg(np.arctan2(ssum, csum)), 360).assign_attrs(raw[name].attrs)
+
+    # variables without time (i.e. the coordinates of the stations) are kept.
+    data = data.assign({name: item for name, item in raw.data_vars.items() if "time" not in item.dims})
+
+    return data.assign_attrs(raw.attrs).assign_attrs(ave_window=int(ave_window), interval_label="end")
+
+
+def build_averaged_tslist(raw_file, target_file, ave_window: int) -> None:
+    """
+    Averages a raw tslist over ave_window minutes (see calc_averaged_tslist) and writes the result to target_file.
+    The raw tslist is opened lazily, so it is never loaded as a whole. The signature (size and mtime) of the raw file
+    is stored in the attribute source_signature.
+    """
+
+    with xr.open_dataset(raw_file, chunks={}) as raw:
+        data = calc_averaged_tslist(raw, ave_window)
+        data = data.assign_attrs(source_file=raw_file.name, source_signature=_file_signature(raw_file))
+
+        # write to a temporary file first, so no reader ever sees a half-written file.
+        tmp_file = target_file.with_name(f".{target_file.name}.{os.getpid()}.tmp")
+        data.to_netcdf(tmp_file)
+
+    os.replace(tmp_file, target_file)
+
+
+def open_averaged_tslist(proj_name, exp_name: str, dom: str, ave_window, verbose=False):
+    """
+    Opens the tslist of an experiment for an averaging window. Files written by ppp (Ave<N>Min_tslist_<dom>.nc) are
+    used if they exist. Any other window is derived from the raw tslist and cached in
+    <workdir>/out/Ave<N>Min_tslist_cache_<dom>.nc, with the same intervals as ppp (see calc_averaged_tslist). The
+    cache is rebuilt if the raw tslist changes.
+
+    Args:
+        proj_name: name of the project
+        exp_name: name of the experiment
+        dom: domain, i.e. d01
+        ave_window: averaging window in minutes, or 0 or "raw" for the raw tslist
+        verbose: if True, speak with user
+
+    Returns: see open_tslist
+
+    """
+
+    if ave_window in [0, "raw"]:
+        return open_tslist(proj_name, exp_name, dom, "raw_tslist")
+
+    prefix = "Ave" + str(ave_window) + "Min"
+    data, list_of_locs, file2load = open_tslist(proj_name, exp_name, dom, f"{prefix}_tslist")
+    if data is not None:
+        return data, list_of_locs, file2load
+
+    raw, list_of_locs, raw_file = open_tslist(proj_name, exp_name, dom, "raw_tslist")
+    if raw is None:
+        return None, list_of_locs, file2load
+
+    data, list_of_locs, cache_file = open_tslist(proj_name, exp_name, dom, f"{prefix}_tslist_cache")
+    if (
+        data is None
+        or data.attrs.get("source_signature") != _file_signature(raw_file)
+        or data.attrs.get("interval_label") != "end"
+    ):
+        if verbose:
+            print(f"Averaging {raw_file} over {ave_window} minutes")
+        build_averaged_tslist(raw_file, cache_file, int(ave_window))
+        data, list_of_locs, cache_file = open_tslist(proj_name, exp_name, dom, f"{prefix}_tslist_cache")
+
+    return data, list_of_locs, cache_file
+
+
 def load_obs_data(obs_data: dict, obs: str, dataset: str, **kwargs):
     """
     This function just loads observations from a single location and stores everything in the obs_data dict.
+    kwargs["AveChoice_Obs"] is the averaging window of the observations in minutes (see select_rollup). The raw data
+    is read by default.
     """
 
-    from src.wrftamer.wrfplotter_classes import Timeseries
+    from wrfplotter.wrfplotter_classes import Timeseries
 
     if obs == '' or dataset is None:
         return
@@ -27,7 +246,7 @@ def load_obs_data(obs_data: dict, obs: str, dataset: str, **kwargs):
         dtend = dt.datetime(ttp.year + 1, 1, 1)
 
     ts = Timeseries(dataset)
-    ts.read_cfconform_data(dtstart, dtend, calc_pt=True)
+    ts.read_cfconform_data(dtstart, dtend, calc_pt=True, ave_window=kwargs.get("AveChoice_Obs"))
 
     if "station_name" in ts.data.dims:
         for stat in ts.data.station_name.values:
@@ -41,11 +260,11 @@ def load_obs_data(obs_data: dict, obs: str, dataset: str, **kwargs):
 
 def load_mod_data(mod_data: dict, exp_name: str, verbose=False, **kwargs):
     """
-    This function just loads model data from a single location and stores everything in the mod_data dict.
+    This function just loads model data and stores everything in the mod_data dict.
+    mod_data[exp_name] is a StationView of all locations of the experiment, i.e. mod_data[exp_name][loc] is the
+    data of a single location.
     """
 
-    from src.wrftamer.main import project
-
     try:
         proj_name = kwargs["proj_name"]
     except KeyError:
@@ -54,43 +273,29 @@ def load_mod_data(mod_data: dict, exp_name: str, verbose=False, **kwargs):
     dom = kwargs["dom"]
     ave_window = kwargs["AveChoice_WRF"]
 
-    if ave_window in [0, "raw"]:
-        prefix = "raw"
-    else:
-        prefix = "Ave" + str(ave_window) + "Min"
-
-    proj = project(proj_name)
-    workdir = proj.get_workdir(exp_name)
-    list_of_locs = proj.exp_list_tslocs(exp_name, verbose=False)
-
-    file2load = workdir / f"out/{prefix}_tslist_{dom}.nc"
+    tmp_xa, list_of_locs, file2load = open_averaged_tslist(proj_name, exp_name, dom, ave_window, verbose)
 
     if verbose:
         print("Searching for file ", file2load)
 
-    if file2load.is_file():
-        tmp_xa = xr.open_dataset(file2load)
-
-        tslist_data = dict()
-        for dim in range(0, tmp_xa.dims["station_name"]):
-            tmp = tmp_xa.isel(station_name=dim)
-
-            loc = str(tmp.station_name.values)
+    if tmp_xa is not None:
+        # select all locations of the experiment at once.
+        stations = tmp_xa["station_name"].values.astype(str)
+        index = np.where(np.isin(stations, list(list_of_locs)))[0]
 
-            if loc in list_of_locs:
-                tslist_data[loc] = tmp
-
-            if bool(tslist_data):
-                mod_data[exp_name] = tslist_data
-            else:
-                print("No data for Experiment ", exp_name)
-                pass  # do not add empty dicts
+        if len(index) > 0:
+            mod_data[exp_name] = StationView(tmp_xa.isel(station_name=index))
+        else:
+            print("No data for Experiment ", exp_name)
+            pass  # do not add empty dicts
     else:
         print("No data for Experiment", exp_name)
 
 
 def load_all_obs_data(dataset, **kwargs):
-    from src.wrftamer.wrfplotter_classes import Timeseries
+    """All stations of a dataset. See load_obs_data for the kwargs."""
+
+    from wrfplotter.wrfplotter_classes import Timeseries
 
     if dataset is None:
         return
@@ -107,24 +312,27 @@ def load_all_obs_data(dataset, **kwargs):
 
     use_dask = kwargs.get("use_dask", True)
 
-    ts.read_cfconform_data(dtstart, dtend, calc_pt=True, use_dask=use_dask)
+    ts.read_cfconform_data(
+        dtstart, dtend, calc_pt=True, use_dask=use_dask, ave_window=kwargs.get("AveChoice_Obs")
+    )
 
     return ts.data
 
 
 def load_all_mod_data(**kwargs):
     """
-    Loads all data (all experiments in <list_of_exps>) for all locations and concats the data to a single dataset.
+    Loads all data (all experiments in <list_of_exps>) for all locations and stacks the data to a single ensemble
+    dataset with the dimension experiment. Experiments are aligned on time and station_name (missing data is NaN).
+    The files are opened in parallel and the data stays lazy (dask).
 
     Args:
-        **kwargs:
+        **kwargs: proj_name, dom, Expvec, AveChoice_WRF or Prediction_Range. max_workers (optional) is the number
+            of threads used to open the files.
 
-    Returns:
+    Returns: the ensemble dataset
 
     """
 
-    from src.wrftamer.main import project
-
     try:
         proj_name = kwargs["proj_name"]
     except KeyError:
@@ -133,47 +341,295 @@ def load_all_mod_data(**kwargs):
     dom = kwargs["dom"]
     ave_window = kwargs.get("AveChoice_WRF", None)
     pred_window = kwargs.get("Prediction_Range", None)
+    expvec = list(kwargs["Expvec"])
 
-    if ave_window in [0, "raw"]:
-        prefix = "raw"
-    else:
-        prefix = "Ave" + str(ave_window) + "Min"
-
-    proj = project(proj_name)
-    all_xa = []
-    for exp_name in kwargs["Expvec"]:
-
-        workdir = proj.get_workdir(exp_name)
-
+    def open_experiment(exp_name):
         if pred_window is None:
-            file2load = f"{workdir}/out/{prefix}_tslist_{dom}.nc"
+            tmp_xa, disc, file2load = open_averaged_tslist(proj_name, exp_name, dom, ave_window)
         else:
-            file2load = f"{workdir}/out/{pred_window}_{dom}.nc"
+            tmp_xa, disc, file2load = open_tslist(proj_name, exp_name, dom, pred_window)
+        if tmp_xa is None:
+            raise FileNotFoundError(file2load)
+        return tmp_xa
 
-        tmp_xa = xr.open_dataset(file2load)
-        all_xa.append(tmp_xa)
-        tmp_xa.close()
+    with ThreadPoolExecutor(max_workers=kwargs.get("max_workers", None)) as executor:
+        all_xa = list(executor.map(open_experiment, expvec))
 
-    all_xa = xr.concat(all_xa, dim="time")
+    all_xa = xr.concat(
+        all_xa, dim=pd.Index(expvec, name="experiment"), join="outer", coords="minimal", compat="override"
+    )
 
     return all_xa
 
 
+def calc_ensemble_statistics(data: xr.Dataset, var: str, percentiles=(10, 50, 90)) -> xr.Dataset:
+    """
+    Ensemble mean, spread (standard deviation) and percentiles of a variable across the dimension experiment
+    (see load_all_mod_data). All are array reductions and stay lazy for dask arrays.
+
+    Args:
+        data: the ensemble dataset
+        var: the variable
+        percentiles: a list of percentiles (0-100)
+
+    Returns: a dataset with the variables mean, spread and percentiles (with the dimension percentile)
+
+    """
+
+    xa = data[var]
+    if xa.chunks is not None:
+        xa = xa.chunk({"experiment": -1})  # quantiles with dask need a single chunk along the reduced dimension
+
+    stats = xr.Dataset()
+    stats["mean"] = xa.mean(dim="experiment", keep_attrs=True)
+    stats["spread"] = xa.std(dim="experiment", keep_attrs=True)
+    quantiles = xa.quantile(np.asarray(percentiles) / 100.0, dim="experiment", keep_attrs=True)
+    stats["percentiles"] = quantiles.rename({"quantile": "percentile"}).assign_coords(percentile=list(percentiles))
+
+    return stats
+
+
 ########################################################################################################################
 #                                                Data Preparation
 ########################################################################################################################
-def get_limits_and_labels(plottype: str, var: str, data=None, map_data=None, units=None, description=None):
+
+
+_interpolation_weights = OrderedDict()
+_interpolation_lock = threading.Lock()
+INTERPOLATION_CACHE_SIZE = 256
+
+
+def calc_interpolation_weights(zvec: np.ndarray, heights) -> (np.ndarray, np.ndarray):
+    """
+    Indices and weights for the linear interpolation of a column to many target heights at once. zvec may change
+    with time and must increase along the model levels. Targets outside the column get the value of the lowest
+    (highest) model level.
+
+    Args:
+        zvec: heights of the model levels, shape (time, model_level)
+        heights: list of target heights
+
+    Returns: idx, the index of the model level below the target, and w, the weight of the level above. Both have the
+        shape (time, number of heights).
+
+    """
+
+    zvec = np.atleast_2d(np.asarray(zvec, dtype=float))
+    heights = np.asarray(heights, dtype=float)
+    ntime, nlev = zvec.shape
+
+    # Shift each time step by a multiple of the total height range, so one searchsorted on the flattened array
+    # finds the bracketing levels of all time steps and heights.
+    span = max(np.nanmax(zvec), np.nanmax(heights)) - min(np.nanmin(zvec), np.nanmin(heights)) + 1.0
+    offset = np.arange(ntime)[:, None] * span
+    pos = np.searchsorted((zvec + offset).ravel(), (heights[None, :] + offset).ravel()).reshape(ntime, -1)
+    idx = np.clip(pos - np.arange(ntime)[:, None] * nlev - 1, 0, nlev - 2)
+
+    z1 = np.take_along_axis(zvec, idx, axis=1)
+    z2 = np.take_along_axis(zvec, idx + 1, axis=1)
+    w = np.clip((heights[None, :] - z1) / (z2 - z1), 0.0, 1.0)
+
+    return idx, w
+
+
+def _data_token(alt: xr.DataArray):
+    """
+    Cheap identity of the data of alt. Dask arrays are identified by their name. A numpy array is identified by
+    the address, shape and strides of its memory; a weak reference to the array owning the memory is returned, so
+    the token is only trusted while that memory is alive. Only data that cannot be referenced is hashed.
+
+    Returns: token, ref (None if the token stays valid)
+    """
+
+    if alt.chunks is not None:
+        return alt.data.name, None
+
+    values = alt.values
+    owner = values
+    while isinstance(owner.base, np.ndarray):
+        owner = owner.base
+
+    try:
+        ref = weakref.ref(owner)
+    except TypeError:
+        return hashlib.sha1(np.ascontiguousarray(values)).hexdigest(), None
+
+    token = (values.__array_interface__["data"][0], values.shape, values.strides, values.dtype.str, alt.dims)
+    return token, ref
+
+
+def get_interpolation_weights(alt: xr.DataArray, heights, key=None) -> (np.ndarray, np.ndarray):
+    """
+    calc_interpolation_weights with a process-wide LRU cache. key (i.e. (experiment, station)) identifies the
+    column; a token of the data of alt is added (see _data_token), so a new version of the data is never served
+    from the cache. Numpy data must not be changed in place. Without a key, nothing is cached.
+    """
+
+    if key is None:
+        return calc_interpolation_weights(alt.transpose("time", "model_level").values, heights)
+
+    token, ref = _data_token(alt)
+    key = (*key, tuple(float(item) for item in heights), token)
+    with _interpolation_lock:
+        if key in _interpolation_weights:
+            entry, cached_ref = _interpolation_weights[key]
+            if cached_ref is None or cached_ref() is not None:
+                _interpolation_weights.move_to_end(key)
+                return entry
+
+    entry = calc_interpolation_weights(alt.transpose("time", "model_level").values, heights)
+
+    with _interpolation_lock:
+        _interpolation_weights[key] = (entry, ref)
+        while len(_interpolation_weights) > INTERPOLATION_CACHE_SIZE:
+            _interpolation_weights.popitem(last=False)
+
+    return entry
+
+
+def interpolate_to_heights(data: xr.Dataset, variables: list, heights, key=None) -> xr.Dataset:
+    """
+    Linear interpolation of the variables of a single station from model levels to the target heights. Only the
+    requested variables are interpolated. If U and V are interpolated, DIR is calculated from the interpolated
+    wind components.
+
+    Args:
+        data: data of a single station with the variable ALT (time, model_level)
+        variables: list of variables to interpolate
+        heights: list of target heights
+        key: key of the column in the cache of weights (see get_interpolation_weights)
+
+    Returns: a dataset with the dimensions time and height
+
+    """
+
+    idx, w = get_interpolation_weights(data["ALT"], heights, key)
+
+    interp = xr.Dataset(coords={"time": data["time"].values, "height": np.asarray(heights, dtype=float)})
+    dir_from_uv = "DIR" in variables and "U" in variables and "V" in variables
+
+    for var in variables:
+        xa = data[var]
+        if "model_level" not in xa.dims:
+            interp[var] = xa
+            continue
+        if var == "DIR" and dir_from_uv:
+            continue  # see below
+
+        values = xa.transpose("time", "model_level").values
+        values = np.take_along_axis(values, idx, axis=1) * (1.0 - w) + np.take_along_axis(values, idx + 1, axis=1) * w
+        interp[var] = xr.DataArray(values, dims=("time", "height"), attrs=xa.attrs)
+
+    if dir_from_uv and "DIR" not in interp:
+        dd = 180.0 / np.pi * np.arctan2(-interp["U"].values, -interp["V"].values)
+        interp["DIR"] = xr.DataArray(np.mod(dd, 360), dims=("time", "height"), attrs=data["DIR"].attrs)
+
+    return interp
+
+
+_limits_cache = OrderedDict()
+_limits_lock = threading.Lock()
+LIMITS_CACHE_SIZE = 128
+
+
+def _limit_arrays(data) -> list:
+    """The arrays (numpy or dask) of a DataFrame, Series, DataArray, array or a list of these."""
+
+    if isinstance(data, (list, tuple)):
+        return [array for item in data for array in _limit_arrays(item)]
+    if isinstance(data, (pd.DataFrame, pd.Series, pd.Index)):
+        return [data.to_numpy(dtype=float)]
+    if isinstance(data, xr.DataArray):
+        return [data.data]
+
+    return [np.asarray(data, dtype=float)]
+
+
+def calc_limits(data, percentiles=None) -> dict:
+    """
+    Minimum and maximum (and optionally percentiles) of all values in a single reduction. NaNs are ignored.
+    Lazy (dask) data is reduced in one computation and the result is cached by the names of the dask arrays, which
+    identify the data. In-memory data is not cached, for reading it once is as expensive as hashing it.
+
+    Args:
+        data: a DataFrame, Series, DataArray (numpy or dask), array or a list of these
+        percentiles: None or a list of percentiles (0-100), i.e. for robust limits [1, 99]. Approximate for lazy
+            data (see dask.array.percentile).
+
+    Returns: a dict with "min", "max" and, if requested, "percentiles". All are nan if there are no valid values.
+
+    """
+
+    arrays = _limit_arrays(data)
+    percentiles = None if percentiles is None else tuple(percentiles)
+
+    if not any(hasattr(array, "dask") for array in arrays):
+        values = np.concatenate([np.empty(0)] + [np.ravel(array).astype(float) for array in arrays])
+        if percentiles is None:
+            return {
+                "min": np.fmin.reduce(values, initial=np.nan),
+                "max": np.fmax.reduce(values, initial=np.nan),
+            }
+
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return {"min": np.nan, "max": np.nan, "percentiles": np.full(len(percentiles), np.nan)}
+        result = np.percentile(values, (0,) + percentiles + (100,))
+        return {"min": result[0], "max": result[-1], "percentiles": result[1:-1]}
+
+    import dask
+    import dask.array as da
+
+    key = (tuple(getattr(array, "name", None) or dask.base.tokenize(array) for array in arrays), percentiles)
+    with _limits_lock:
+        if key in _limits_cache:
+            _limits_cache.move_to_end(key)
+            return _limits_cache[key]
+
+    values = da.concatenate([da.asarray(array).ravel().astype(float) for array in arrays])
+    reductions = {"min": da.nanmin(values), "max": da.nanmax(values)}
+    if percentiles is not None:
+        reductions["percentiles"] = da.percentile(values[~da.isnan(values)], list(percentiles), method="linear")
+
+    with np.errstate(all="ignore"), warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN chunks
+        limits = dict(zip(reductions, dask.compute(*reductions.values())))
+
+    with _limits_lock:
+        _limits_cache[key] = limits
+        while len(_limits_cache) > LIMITS_CACHE_SIZE:
+            _limits_cache.popitem(last=False)
+
+    return limits
+
+
+def get_range(limits: dict, robust=False) -> (float, float):
+    """(lower, upper) of limits (see calc_limits): the extrema or, if robust, the first and last percentile."""
+
+    if robust and "percentiles" in limits:
+        return limits["percentiles"][0], limits["percentiles"][-1]
+
+    return limits["min"], limits["max"]
+
+
+def get_limits_and_labels(
+    plottype: str, var: str, data=None, map_data=None, units=None, description=None, percentiles=None
+):
+    """
+    Limits and labels of a plot. The limits of each input are calculated in a single reduction (see calc_limits).
+    With percentiles (i.e. [1, 99]), the limits of the values are robust: the first and last percentile instead of
+    the extrema.
+    """
+
     infos = dict()
+    robust = percentiles is not None
     infos["plottype"] = plottype
     infos["var"] = var
 
     if plottype == "Profiles":
 
-        infos["ylim"] = [0, np.nanmax([item.ALT.max() for item in data])]
-        infos["xlim"] = [
-            np.nanmin([item.iloc[:, 1].min() for item in data]),
-            np.nanmax([item.iloc[:, 1].max() for item in data]),
-        ]
+        infos["ylim"] = [0, calc_limits([item.ALT for item in data])["max"]]
+        infos["xlim"] = list(get_range(calc_limits([item.iloc[:, 1] for item in data], percentiles), robust))
 
         infos["xlabel"] = f"{description} ({units})"
         infos["ylabel"] = "z (m)"
@@ -182,10 +638,8 @@ def get_limits_and_labels(plottype: str, var: str, data=None, map_data=None, uni
 
     elif plottype == "Timeseries":
 
-        infos["ylim"] = [
-            np.floor(np.nanmin(data.min())),
-            np.ceil(np.nanmax(data.max())),
-        ]
+        vmin, vmax = get_range(calc_limits(data, percentiles), robust)
+        infos["ylim"] = [np.floor(vmin), np.ceil(vmax)]
         infos["tlim"] = [data.index.min(), data.index.max()]
 
         infos["xlabel"] = "time (UTC)"
@@ -201,8 +655,8 @@ def get_limits_and_labels(plottype: str, var: str, data=None, map_data=None, uni
 
     elif plottype == 'Windrose':
 
-        wsp_data, dir_data = data
-        infos["wspmax"] = np.ceil(wsp_data.max().max())
+        wsp_data = data[0]
+        infos["wspmax"] = np.ceil(calc_limits(wsp_data)["max"])
 
         infos["xlabel"] = ""
         infos["ylabel"] = ""
@@ -211,8 +665,8 @@ def get_limits_and_labels(plottype: str, var: str, data=None, map_data=None, uni
 
     elif plottype == "Obs vs Mod":
 
-        vmin = np.floor(np.nanmin(data.min()))
-        vmax = np.ceil(np.nanmax(data.max()))
+        vmin, vmax = get_range(calc_limits(data, percentiles), robust)
+        vmin, vmax = np.floor(vmin), np.ceil(vmax)
 
         infos["ylim"] = [vmin, vmax]
         infos["xlim"] = [vmin, vmax]
@@ -224,11 +678,10 @@ def get_limits_and_labels(plottype: str, var: str, data=None, map_data=None, uni
 
     elif plottype == "zt-Plot":
 
-        infos["clim"] = [np.floor(data.values.min()), np.ceil(data.values.max())]
-        infos["ylim"] = [
-            np.floor(data.indexes["ALT"].min()),
-            np.ceil(data.indexes["ALT"].max()),
-        ]
+        vmin, vmax = get_range(calc_limits(data, percentiles), robust)
+        alt = calc_limits(data["ALT"])
+        infos["clim"] = [np.floor(vmin), np.ceil(vmax)]
+        infos["ylim"] = [np.floor(alt["min"]), np.ceil(alt["max"])]
         infos["tlim"] = [data.indexes["time"].min(), data.indexes["time"].max()]
 
         infos["xlabel"] = "time (UTC)"
@@ -238,7 +691,8 @@ def get_limits_and_labels(plottype: str, var: str, data=None, map_data=None, uni
 
     elif plottype in ["Map", "MapSequence"]:
 
-        vmin, vmax = np.floor(map_data.values.min()), np.ceil(map_data.values.max())
+        vmin, vmax = get_range(calc_limits(map_data, percentiles), robust)
+        vmin, vmax = np.floor(vmin), np.ceil(vmax)
         cmapname = "viridis"  # standard colormap
 
         if map_data.name in ["DIR", "dir", "dd"]:
@@ -253,8 +707,9 @@ def get_limits_and_labels(plottype: str, var: str, data=None, map_data=None, uni
             cmapname = "jet"
 
         infos["clim"] = [vmin, vmax]
-        infos["xlim"] = [map_data.XLONG.values.min(), map_data.XLONG.values.max()]
-        infos["ylim"] = [map_data.XLAT.values.min(), map_data.XLAT.values.max()]
+        lon, lat = calc_limits(map_data.XLONG), calc_limits(map_data.XLAT)
+        infos["xlim"] = [lon["min"], lon["max"]]
+        infos["ylim"] = [lat["min"], lat["max"]]
         infos["xlabel"] = "longitude (°)"
         infos["ylabel"] = "latitude (°)"
         infos[
@@ -267,6 +722,79 @@ def get_limits_and_labels(plottype: str, var: str, data=None, map_data=None, uni
     return infos
 
 
+def select_times(data, times, tolerance=None):
+    """
+    Selects time steps by an index lookup. Without a tolerance, the time steps must exist. With a tolerance, the
+    nearest time step within the tolerance is selected.
+
+    Args:
+        data: a dataset or a DataArray with the dimension time
+        times: list of time steps
+        tolerance: None or the maximum distance to the nearest time step, i.e. "5min" or a pd.Timedelta
+
+    Returns: the selected data. Raises an IndexError if a time step is not found.
+
+    """
+
+    try:
+        if tolerance is None:
+            return data.sel(time=times)
+        return data.sel(time=times, method="nearest", tolerance=pd.Timedelta(tolerance))
+    except KeyError:
+        raise IndexError(f"No data found at {times}")
+
+
+def get_obs_profiles(data: xr.Dataset, var: str, device: str, times, tolerance=None) -> xr.DataArray:
+    """
+    Profiles of an observed variable (all heights of var, measured with device) at many time steps at once, i.e. for
+    animations or time-averaged profiles.
+
+    Args:
+        data: observations of a single station
+        var: the variable, i.e. WSP
+        device: the device, i.e. USA (see variable_index)
+        times: list of time steps
+        tolerance: see select_times
+
+    Returns: a DataArray with the dimensions time and height
+
+    """
+
+    index = get_variable_index(data)
+    heights = index.heights(var, device)
+    names = [index.name(var, device, zz) for zz in heights]
+
+    data = xr.Dataset({name: data[name] for name in names}, coords={"time": data["time"]})
+    data = select_times(data, times, tolerance)
+    values = np.empty((data.sizes["time"], len(names)))
+    for ii, name in enumerate(names):
+        values[:, ii] = data[name].values
+
+    attrs = {"units": index.units[names[0]]} if len(names) > 0 else {}
+
+    coords = {"time": data["time"].values, "height": heights}
+    return xr.DataArray(values, dims=("time", "height"), coords=coords, name=var, attrs=attrs)
+
+
+def get_mod_profiles(data: xr.Dataset, var: str, times, tolerance=None) -> xr.DataArray:
+    """
+    Profiles of a model variable at many time steps at once, i.e. for animations or time-averaged profiles.
+
+    Args:
+        data: model data of a single station
+        var: the variable
+        times: list of time steps
+        tolerance: see select_times
+
+    Returns: a DataArray with the dimensions time and model_level and the coordinate ALT
+
+    """
+
+    data = select_times(data[[var, "ALT"]], times, tolerance)
+
+    return data[var].assign_coords(ALT=data["ALT"])
+
+
 def prep_profile_data(obs_data, mod_data, infos: dict, verbose=False) -> (list, str, str):
     """
     Takes the data coming from my classes, selects the right data and puts everyting in a list.
@@ -281,55 +809,34 @@ def prep_profile_data(obs_data, mod_data, infos: dict, verbose=False) -> (list,
     loc = infos["loc"]
     time_to_plot = infos["time_to_plot"]
     ttp = np.datetime64(time_to_plot)
+    tolerance = infos.get("time_tolerance", None)
     expvec = infos["Expvec"]
     obsvec = infos["Obsvec"]
 
-    # change a few parameter Names to fit the
-    translator = {
-        "WSP": {"Sonic": "_USA", "Analog": "_CUP"},
-        "DIR": {"Sonic": "_USA", "Analog": "_VANE"},
-    }
-    if var in ["WSP", "DIR"]:
-        device = translator.get(var, "").get(anemometer, "")
-    else:
-        device = ""
+    # device of the obs-files
+    device = get_device(var, anemometer)
 
+    units, description = "", "No Data"
     data2plot = []
     for obs in obsvec:
-        zvec, data = [], []
-        myobs = obs_data[obs]
-        myobs = myobs.where(myobs.time == ttp, drop=True)
-
-        for key in myobs.keys():
-            if var in key and "std" not in key:
-                if device == "":
-                    if (
-                            "CUP" not in key
-                            and "USA" not in key
-                            and "VANE" not in key
-                            and key.startswith(var + "_")
-                    ):
-                        zvec.append(float(key.split("_")[1]))
-                        data.append(myobs[key].values[0])
-
-                elif device in key:
-                    zvec.append(float(key.rsplit("_", 1)[1]))
-                    data.append(myobs[key].values[0])
-                    units = myobs[key].units
-                    description = var  # (standard_name contains height)
-
-        df = pd.DataFrame({"ALT": zvec, loc: data})
+        try:
+            myobs = get_obs_profiles(obs_data[obs], var, device, [ttp], tolerance).isel(time=0)
+        except IndexError:
+            if verbose:
+                print(f"No observations found at this time: {time_to_plot}")
+            continue
+
+        if myobs.sizes["height"] > 0:
+            units = myobs.units
+            description = var  # (standard_name contains height)
+
+        df = pd.DataFrame({"ALT": myobs["height"].values, loc: myobs.values})
         data2plot.append(df)
 
     for exp in expvec:
         try:
-            mymod = mod_data[exp][loc]
-            mymod = mymod.where(mymod.time == ttp, drop=True)
-            mymod = mymod.to_dataframe()
-            mymod = mymod.set_index("ALT")
-            mymod = pd.DataFrame(mymod[var])
-            mymod = mymod.rename(columns={var: exp})
-            mymod = mymod.reset_index()
+            mymod = get_mod_profiles(mod_data[exp][loc], var, [ttp], tolerance).isel(time=0)
+            mymod = pd.DataFrame({"ALT": mymod["ALT"].values, exp: mymod.values})
             data2plot.append(mymod)
 
             units = mod_data[exp][loc][var].units
@@ -345,23 +852,225 @@ def prep_profile_data(obs_data, mod_data, infos: dict, verbose=False) -> (list,
     return data2plot, units, description
 
 
-def prep_zt_data(mod_data, infos: dict) -> xr.Dataset:
-    var = infos["var"]
+def prep_all_zt_data(mod_data, infos: dict, variables=None, expvec=None) -> dict:
+    """
+    Prepares the data of several experiments and variables for zt-plots. The data stays lazy (dask) and is restricted
+    to the requested time window before anything is computed.
+
+    Args:
+        mod_data: dict of model data
+        infos: loc; optional: zt_from_to (start and end of the time window) and zt_heights: "mean" (time-mean
+            heights of the model levels as dimension ALT) or "exact" (time-varying heights as 2D coordinate ALT, which
+            can be plotted as a curvilinear quadmesh)
+        variables: list of variables, infos["var"] by default
+        expvec: list of experiments, all experiments in mod_data by default
+
+    Returns: a dict with a dataset (of all variables) per experiment
+
+    """
+
     loc = infos["loc"]
+    time_window = infos.get("zt_from_to", None)
+    heights = infos.get("zt_heights", "mean")
+
+    if variables is None:
+        variables = [infos["var"]]
+    if expvec is None:
+        expvec = list(mod_data.keys())
+
+    if heights not in ["mean", "exact"]:
+        print(f"zt_heights must be mean or exact, not {heights}")
+        raise ValueError
+
+    all_data = dict()
+    for exp in expvec:
+        data2plot = mod_data[exp][loc][list(variables) + ["ALT"]]
+        if time_window is not None:
+            data2plot = data2plot.sel(time=slice(*time_window))
+
+        if heights == "mean":
+            new_z = data2plot["ALT"].mean(dim="time", keep_attrs=True)
+            data2plot = data2plot.drop_vars("ALT").assign_coords(ALT=new_z)
+            data2plot = data2plot.swap_dims({"model_level": "ALT"}).drop_vars("model_level", errors="ignore")
+        else:
+            data2plot = data2plot.set_coords("ALT")
+
+        all_data[exp] = data2plot
+
+    return all_data
+
+
+def prep_zt_data(mod_data, infos: dict) -> xr.DataArray:
+    """
+    The data of the variable infos["var"] of a single experiment (infos["Expvec"][0], or the first in mod_data)
+    for zt-plots. See prep_all_zt_data.
+    """
+
+    expvec = infos.get("Expvec", None)
+    exp = expvec[0] if expvec else list(mod_data.keys())[0]
+
+    return prep_all_zt_data(mod_data, infos, expvec=[exp])[exp][infos["var"]]
+
+
+def aggregate_time(data: xr.DataArray, nbins: int, how="mean") -> xr.DataArray:
+    """
+    Aggregates the time axis of zt-data to at most nbins bins (i.e. the width of a plot in pixels) of an equal number
+    of time steps. Time and a time-varying ALT are averaged per bin. Stays lazy for dask arrays.
+
+    Args:
+        data: the data, see prep_zt_data
+        nbins: maximum number of time steps
+        how: mean or max
+
+    Returns: the aggregated data; data itself, if it has no more than nbins time steps
+
+    """
+
+    if how not in ["mean", "max"]:
+        print(f"Cannot aggregate with {how}. Use mean or max")
+        raise ValueError
+
+    window = int(np.ceil(data.sizes["time"] / max(int(nbins), 1)))
+    if window <= 1:
+        return data
+
+    coarse = data.coarsen(time=window, boundary="pad", coord_func="mean")
+    return getattr(coarse, how)(keep_attrs=True)
+
+
+def _to_series(xa: xr.DataArray, name: str) -> pd.Series:
+    """
+    A time series of a DataArray with the single dimension time. The series is built directly on the time index and
+    the values of the DataArray (no intermediate DataFrame of the whole dataset).
+    """
+
+    return pd.Series(xa.values, index=xa.indexes["time"], name=name, copy=False)
+
+
+def calc_alignment_index(source, target, tolerance=None, direction="nearest") -> (np.ndarray, np.ndarray):
+    """
+    As-of join of two time axes: for each target time, the index of the matching source time.
+
+    Args:
+        source: sorted time axis of the data that is aligned
+        target: time axis to align to
+        tolerance: None or the maximum distance between the times, i.e. "5min" or a pd.Timedelta
+        direction: nearest, backward (last source time <= target time) or forward (first source time >= target time)
+
+    Returns: idx (the index of the source time for each target time) and valid (False, if no source time matches)
+
+    """
+
+    source = np.asarray(source, dtype="datetime64[ns]").astype(np.int64)
+    target = np.asarray(target, dtype="datetime64[ns]").astype(np.int64)
+    nsource = len(source)
+
+    if nsource == 0:
+        return np.zeros(len(target), dtype=int), np.zeros(len(target), dtype=bool)
+
+    right = np.searchsorted(source, target, side="left")  # first source time >= target time
+    if direction == "forward":
+        valid = right < nsource
+        idx = right
+    elif direction == "backward":
+        idx = np.searchsorted(source, target, side="right") - 1
+        valid = idx >= 0
+    elif direction == "nearest":
+        left = np.clip(right - 1, 0, nsource - 1)
+        right = np.clip(right, 0, nsource - 1)
+        idx = np.where(np.abs(source[right] - target) < np.abs(source[left] - target), right, left)
+        valid = np.ones(len(target), dtype=bool)
+    else:
+        print(f"direction must be nearest, backward or forward, not {direction}")
+        raise ValueError
+
+    idx = np.clip(idx, 0, nsource - 1)
+    if tolerance is not None:
+        valid &= np.abs(source[idx] - target) <= pd.Timedelta(tolerance).value
+
+    return idx, valid
+
+
+def align_to_times(data, times, tolerance=None, direction="nearest", offset=None):
+    """
+    Aligns a series or a dataframe (all columns at once) to the time axis times (see calc_alignment_index).
+
+    Args:
+        data: a pd.Series or a pd.DataFrame with a sorted DatetimeIndex
+        times: the new time axis
+        tolerance: see calc_alignment_index
+        direction: see calc_alignment_index
+        offset: None or a shift of the time axis of data before the alignment, i.e. "5min" if data is labeled at the
+            start and the target at the center of 10 min intervals.
+
+    Returns: data with the index times. Values without a match are NaN.
+
+    """
+
+    source = data.index
+    if offset is not None:
+        source = source + pd.Timedelta(offset)
+
+    idx, valid = calc_alignment_index(source, times, tolerance, direction)
 
-    key = list(mod_data.keys())[0]
-    data2plot = mod_data[key][loc]
+    values = data.to_numpy(dtype=float)[idx]
+    values[~valid] = np.nan
 
-    # new_z
-    new_z = mod_data[key][loc]["ALT"].mean(axis=0, keep_attrs=True)
-    data2plot = data2plot.drop_vars("ALT")
-    data2plot = data2plot.rename_vars({"model_level": "ALT"})
+    if isinstance(data, pd.Series):
+        return pd.Series(values, index=pd.Index(times, name=data.index.name), name=data.name)
+    return pd.DataFrame(values, index=pd.Index(times, name=data.index.name), columns=data.columns)
 
-    data2plot["ALT"] = new_z
-    data2plot = data2plot.swap_dims({"model_level": "ALT"})
-    data2plot = data2plot.drop_vars("model_level")
 
-    return data2plot[var]
+DENSITY_THRESHOLD = 50000
+
+
+def use_density(data: pd.DataFrame, density=None, threshold=DENSITY_THRESHOLD) -> bool:
+    """
+    If an obs vs mod plot should show the density of the pairs instead of single points. Automatic (density=None),
+    if the number of values of the models exceeds threshold.
+    """
+
+    if density is not None:
+        return bool(density)
+
+    return int(data.iloc[:, 1:].count().sum()) > threshold
+
+
+def calc_obs_vs_mod_density(data: pd.DataFrame, bins=100, lims=None, quantiles=None) -> dict:
+    """
+    2D histograms of model against observation (the first column) for all models, for density plots of large data.
+    Optionally, the quantiles for quantile-quantile plots are calculated in the same pass.
+
+    Args:
+        data: a dataframe with the observation in the first column and a column per model
+        bins: number of bins in each direction
+        lims: (min, max) of the bins (same for obs and model). The range of the data by default.
+        quantiles: None or a list of quantiles (0-1)
+
+    Returns: a dict with the edges of the bins ("edges"), the counts (shape (obs, model)) per model ("counts") and
+        the quantiles of obs and model per model ("qq"; only pairs where both are valid are used).
+
+    """
+
+    values = data.to_numpy(dtype=float)
+    obs = values[:, 0]
+
+    if lims is None:
+        lims = (np.nanmin(values), np.nanmax(values)) if np.isfinite(values).any() else (0, 1)
+    edges = np.linspace(lims[0], lims[1], bins + 1)
+
+    density = {"edges": edges, "counts": dict(), "qq": dict()}
+    for idx, model in enumerate(data.columns[1:], start=1):
+        valid = ~np.isnan(obs) & ~np.isnan(values[:, idx])
+        density["counts"][model], disc, disc = np.histogram2d(obs[valid], values[valid, idx], bins=[edges, edges])
+
+        if quantiles is not None and valid.any():
+            density["qq"][model] = (
+                np.quantile(obs[valid], quantiles),
+                np.quantile(values[valid, idx], quantiles),
+            )
+
+    return density
 
 
 def prep_ts_data(obs_data, mod_data, infos: dict, verbose=False) -> (pd.DataFrame, str, str):
@@ -377,6 +1086,10 @@ def prep_ts_data(obs_data, mod_data, infos: dict, verbose=False) -> (pd.DataFram
     var: variable to plot
     lev: level at which the varialbe is valid
     anemometer: device used for observation
+    align_tolerance (optional): if given, the observations are aligned to the time axis of the models (see
+        align_to_times), which gives dense, paired data. Otherwise, the union of all time axes is used.
+    align_direction (optional): nearest (default), backward or forward
+    obs_offset (optional): shift of the time axis of the observations before the alignment
     """
 
     anemometer = infos["anemometer"]
@@ -385,21 +1098,21 @@ def prep_ts_data(obs_data, mod_data, infos: dict, verbose=False) -> (pd.DataFram
     obsvec = infos["Obsvec"]
     var = infos["var"]
     lev = infos["lev"]
+    tolerance = infos.get("align_tolerance", None)
+    direction = infos.get("align_direction", "nearest")
+    offset = infos.get("obs_offset", None)
 
     if len(mod_data) > 0:
         tmp_t = mod_data[list(mod_data.keys())[0]][loc].time.values
         tlim1 = pd.Timestamp(tmp_t.min())
         tlim2 = pd.Timestamp(tmp_t.max())
+        if tolerance is not None:  # observations that can be aligned to the first or last time step are needed
+            pad = pd.Timedelta(tolerance)
+            shift = pd.Timedelta(offset) if offset is not None else pd.Timedelta(0)
+            tlim1, tlim2 = tlim1 - shift - pad, tlim2 - shift + pad
 
-    # change a few parameter Names to fit the name of the obs-files
-    translator = {
-        "WSP": {"Sonic": "_USA", "Analog": "_CUP"},
-        "DIR": {"Sonic": "_USA", "Analog": "_VANE"},
-    }
-    if var in ["WSP", "DIR"]:
-        device = translator.get(var, "").get(anemometer, "")
-    else:
-        device = ""
+    # device of the obs-files
+    device = get_device(var, anemometer)
 
     if var == 'PRES':
         description = "air pressure"
@@ -411,16 +1124,19 @@ def prep_ts_data(obs_data, mod_data, infos: dict, verbose=False) -> (pd.DataFram
 
     for obs in obsvec:
         try:
-            myobs = obs_data[obs].to_dataframe()
+            myobs = obs_data[obs]
+
+            # Two different naming conventions exist right now. In the future, reduces to one.
+            if var in myobs.data_vars:
+                myobs = myobs[var]
+            else:
+                myobs = myobs[get_variable_index(myobs).name(var, device, lev)]
+            units = myobs.units
 
-            try:  # Two different naming conventions exist right now. In the future, reduces to one.
-                tmp = myobs[var]
-                units = obs_data[obs][var].units
-            except KeyError:
-                tmp = myobs[f"{var}{device}_{lev}"]
-                units = obs_data[obs][f"{var}{device}_{lev}"].units
+            if len(mod_data) > 0:
+                myobs = myobs.sel(time=slice(tlim1, tlim2))
 
-            tmp = tmp.rename(obs)
+            tmp = _to_series(myobs, obs)
 
         except KeyError:
             tmp = pd.DataFrame()
@@ -428,9 +1144,6 @@ def prep_ts_data(obs_data, mod_data, infos: dict, verbose=False) -> (pd.DataFram
             units = ""
             description = "No Data"
 
-        if len(mod_data) > 0:
-            tmp = tmp[tlim1:tlim2]
-
         all_df.append(tmp)
 
     for exp in expvec:
@@ -440,30 +1153,27 @@ def prep_ts_data(obs_data, mod_data, infos: dict, verbose=False) -> (pd.DataFram
             units = mymod[var].units
             description = mymod[var].standard_name
 
-            # interpolate all data to desired level
-            zvec = mymod.ALT[0, :].values
-            idx = (np.abs(zvec - float(lev))).argmin()
-            xa1 = mymod.isel(model_level=idx)
-            xa2 = mymod.isel(model_level=idx + 1)
-            w1 = abs(zvec[idx] - float(lev)) / abs(zvec[idx + 1] - zvec[idx])
-            w2 = abs(zvec[idx + 1] - float(lev)) / abs(zvec[idx + 1] - zvec[idx])
-            mymod = xa1 * w2 + xa2 * w1
-
-            if 'DIR' in mymod and 'U' in mymod and 'V' in mymod:
-                dd = 180.0 / np.pi * np.arctan2(-mymod['U'].values, -mymod['V'].values)
-                dd = np.mod(dd, 360)
-                mymod['DIR'].values = dd
-
-            mymod = mymod.to_dataframe()
-
-            tmp = mymod[var]
-            tmp = tmp.rename(exp)
+            # interpolate the variable to the desired level
+            variables = [var]
+            if var == "DIR":
+                variables += [item for item in ["U", "V"] if item in mymod]
+            mymod = interpolate_to_heights(mymod, variables, [float(lev)], key=(exp, loc))
+            tmp = _to_series(mymod[var].isel(height=0), exp)
             all_df.append(tmp)
 
         except KeyError:
             if verbose:
                 print(f"No Data for Experiment {exp}")
 
+    if tolerance is not None and len(all_df) > len(obsvec):
+        mod_df = pd.concat(all_df[len(obsvec):], axis=1)
+        obs_df = [
+            align_to_times(item, mod_df.index, tolerance, direction, offset)
+            for item in all_df[:len(obsvec)]
+            if len(item) > 0
+        ]
+        all_df = obs_df + [mod_df]
+
     if len(all_df) > 0:
         data2plot = pd.concat(all_df, axis=1)
     else:
@@ -478,54 +1188,175 @@ def prep_ts_data(obs_data, mod_data, infos: dict, verbose=False) -> (pd.DataFram
     return data2plot, units, description
 
 
-def prep_windrose_data(obs_data, mod_data, infos: dict, verbose=False) -> ((pd.DataFrame, pd.DataFrame), str, str):
+def prep_windrose_data(
+    obs_data, mod_data, infos: dict, verbose=False
+) -> ((pd.DataFrame, pd.DataFrame, xr.DataArray), str, str):
     """
-    Takes the data coming from my classes, selects the right data and concats
-    everything into a single dataframe for easy plotting with hvplot.
+    Takes the data coming from my classes and selects wind speed and wind direction in a single pass. Returns two
+    dataframes (speed and direction) with the same index and columns and their frequency tables (see
+    calc_windrose_tables). The data is binned once here; all wind roses are drawn from these tables.
 
     obs_data: dict of observations
     mod_data: dict of model data
     expvec: list of experiments to plot
     obsvec: list of observations to plot
     loc: location of the time series
-    var: variable to plot
-    lev: level at which the varialbe is valid
+    lev: level at which the wind speed is valid. The observed direction is taken at the closest level.
     anemometer: device used for observation
     """
 
-    infos2 = infos.copy()
-    infos2['var'] = 'DIR'
+    loc = infos["loc"]
+    lev = infos["lev"]  # this is for WSP
+    device = get_device("WSP", infos["anemometer"])
+    device2 = get_device("DIR", infos["anemometer"])
 
-    anemometer = infos["anemometer"]
-    if anemometer == 'Sonic':
-        device2 = '_USA'
-    else:
-        device2 = '_VANE'
+    if len(mod_data) > 0:
+        tmp_t = mod_data[list(mod_data.keys())[0]][loc].time.values
+        tlim1 = pd.Timestamp(tmp_t.min())
+        tlim2 = pd.Timestamp(tmp_t.max())
 
-    obsvec = infos["Obsvec"]
-    obs = obsvec[0]
-    lev = infos["lev"]  # this is for WSP
+    all_wsp, all_dir = [], []
 
-    if len(obs_data) > 0:
-        # get lev2, which is the closest level to WSP.
-        possible_levs2 = []
-        varnames = list(obs_data[obs].variables)
-        for var in varnames:
-            if var.startswith(f'DIR{device2}'):
-                possible_levs2.append(int(var.split('_')[-1]))
+    for obs in infos["Obsvec"]:
+        try:
+            myobs = obs_data[obs]
+            index = get_variable_index(myobs)
+            wsp_name = "WSP" if "WSP" in myobs.data_vars else index.name("WSP", device, lev)
+            # the direction is taken at the level closest to WSP.
+            dir_name = "DIR" if "DIR" in myobs.data_vars else index.closest("DIR", device2, lev)[0]
+
+            myobs = xr.Dataset({"WSP": myobs[wsp_name], "DIR": myobs[dir_name]})
+            if len(mod_data) > 0:
+                myobs = myobs.sel(time=slice(tlim1, tlim2))
 
-        try:  # Capture fail if varname is not of the form DIR_{device}_{level}
-            idx = np.argmin(abs(np.asarray(possible_levs2) - int(lev)))
-            lev2 = str(possible_levs2[idx])
-        except ValueError:
-            lev2 = lev
+            all_wsp.append(_to_series(myobs["WSP"], obs))
+            all_dir.append(_to_series(myobs["DIR"], obs))
 
-        infos2['lev'] = lev2
+        except (KeyError, ValueError):
+            if verbose:
+                print(f"No wind data for Observation {obs}")
 
-    wsp_data, disc, disc = prep_ts_data(obs_data, mod_data, infos, verbose=verbose)
-    dir_data, disc, disc = prep_ts_data(obs_data, mod_data, infos2, verbose=verbose)
+    for exp in infos["Expvec"]:
+        try:
+            mymod = mod_data[exp][loc]
+            variables = ["WSP", "DIR"] + [item for item in ["U", "V"] if item in mymod]
+
+            # a single interpolation for speed and direction (computed from U and V, if available)
+            mymod = interpolate_to_heights(mymod, variables, [float(lev)], key=(exp, loc)).isel(height=0)
+
+            all_wsp.append(_to_series(mymod["WSP"], exp))
+            all_dir.append(_to_series(mymod["DIR"], exp))
+
+        except KeyError:
+            if verbose:
+                print(f"No Data for Experiment {exp}")
+
+    if len(all_wsp) > 0:
+        wsp_data = pd.concat(all_wsp, axis=1)
+        dir_data = pd.concat(all_dir, axis=1)
+    else:
+        wsp_data = pd.DataFrame(
+            {
+                "time": [dt.datetime(1970, 1, 1), dt.datetime(2020, 1, 1)],
+                "data": [np.nan, np.nan],
+            }
+        )
+        wsp_data = wsp_data.set_index("time")
+        dir_data = wsp_data.copy()
+
+    tables = get_windrose_tables(wsp_data, dir_data)
 
     units = 'm s-1, degree'
     description = 'wind speed and wind direction'
 
-    return (wsp_data, dir_data), units, description
+    return (wsp_data, dir_data, tables), units, description
+
+
+WINDROSE_SECTORS = 32
+
+
+def get_windrose_bins(wspmax, nbins=10) -> np.ndarray:
+    """Speed bins of the wind roses: lower edges of about nbins bins of integer width from 0 to wspmax."""
+
+    if not np.isfinite(wspmax) or wspmax <= 0:
+        wspmax = 1.0
+
+    num = np.ceil(wspmax / nbins)
+    return np.arange(0, wspmax + num, num)
+
+
+def get_windrose_tables(wsp_data: pd.DataFrame, dir_data: pd.DataFrame, tables=None, wspmax=None) -> xr.DataArray:
+    """
+    The frequency tables of the wind roses with the speed bins up to wspmax (see get_windrose_bins), or up to the
+    maximum wind speed if wspmax is None. Tables that were already calculated (i.e. by prep_windrose_data) are
+    reused if their speed bins match.
+    """
+
+    if wspmax is None:
+        wspmax = np.ceil(calc_limits(wsp_data)["max"])
+
+    bins = get_windrose_bins(wspmax)
+    if tables is not None and np.array_equal(tables.speed.values, bins):
+        return tables
+
+    return calc_windrose_tables(wsp_data, dir_data, bins)
+
+
+def calc_windrose_table(wsp, wdir, bins, nsector=WINDROSE_SECTORS, normed=True) -> np.ndarray:
+    """
+    The frequency table of a wind rose, binned once with np.histogram2d.
+
+    Args:
+        wsp: wind speed
+        wdir: wind direction in degree
+        bins: lower edges of the speed bins. The last bin is open.
+        nsector: number of direction sectors. The first sector is centred on north, sectors are counted clockwise.
+        normed: if True, the table is in percent of all valid pairs; counts otherwise.
+
+    Returns: the table, shape (speed bins, sectors), as used by windrose.
+
+    """
+
+    wsp = np.asarray(wsp, dtype=float)
+    wdir = np.asarray(wdir, dtype=float)
+    valid = ~np.isnan(wsp) & ~np.isnan(wdir)
+
+    width = 360.0 / nsector
+    table, disc, disc = np.histogram2d(
+        wsp[valid],
+        np.mod(wdir[valid] + width / 2, 360.0),
+        bins=[np.append(bins, np.inf), np.linspace(0, 360, nsector + 1)],
+    )
+
+    if normed and valid.any():
+        table = table * 100.0 / valid.sum()
+
+    return table
+
+
+def calc_windrose_tables(
+    wsp_data: pd.DataFrame, dir_data: pd.DataFrame, bins, nsector=WINDROSE_SECTORS
+) -> xr.DataArray:
+    """
+    Frequency tables (in percent) of all columns of the wind data (see prep_windrose_data and calc_windrose_table).
+    The tables are shared by the matplotlib and the bokeh wind roses and can be compared or stored directly.
+
+    Returns: a DataArray with the dims (column, speed, sector). speed holds the lower edges of the speed bins, sector
+        the centres of the sectors in degree.
+
+    """
+
+    columns = list(wsp_data.columns)
+    tables = [calc_windrose_table(wsp_data[col].values, dir_data[col].values, bins, nsector) for col in columns]
+
+    return xr.DataArray(
+        np.reshape(tables, (len(columns), len(bins), nsector)),
+        dims=("column", "speed", "sector"),
+        coords={
+            "column": columns,
+            "speed": np.asarray(bins, dtype=float),
+            "sector": np.arange(nsector) * 360.0 / nsector,
+        },
+        name="frequency",
+        attrs={"units": "%"},
+    )
@@ -1,10 +1,18 @@
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 from matplotlib.dates import DateFormatter
 from windrose import WindroseAxes
 import xarray as xr
 import panel as pn
+from wrfplotter.load_and_prepare import (
+    DENSITY_THRESHOLD,
+    use_density,
+    calc_obs_vs_mod_density,
+    get_windrose_tables,
+    aggregate_time,
+)
 
 try:
     # Taken from mpl_plots
@@ -46,8 +54,7 @@ def create_mpl_plot(data, infos: dict):
         figure = Histogram(data, **infos)
 
     elif plottype == 'Windrose':
-        wsp_data, dir_data = data
-        figs = Windrose(wsp_data, dir_data, **infos)
+        figs = Windrose(*data, **infos)  # speed, direction and their frequency tables, see prep_windrose_data
         if len(figs) == 2:
             figure = pn.Row(figs[0], figs[1])
         elif len(figs) == 1:
@@ -248,12 +255,19 @@ def TimeSeries(data, col=None, sty=None, label=None, **kwargs):
 
 # ----------------------------------------------------------------------------------------------------------------------
 def zt(data, **kwargs):
+    """
+    zt-plot. The time axis is aggregated to the width of the axes in pixels (zt_aggregate: mean (default), max or
+    None for full resolution; zt_bins overrides the width) and drawn with 20 color levels as a pcolormesh. Only the
+    field is rasterized, so vector output (svg, pdf) stays small.
+    """
+
     font_size = kwargs.get("font_size", 10)
     clim = kwargs.get("clim", (0, 1))
     tlim = kwargs.get("tlim", (0, 1))
     ylim = kwargs.get("ylim", (0, 1))
     xlabel = kwargs.get("xlabel", "")
     ylabel = kwargs.get("ylabel", "")
+    aggregate = kwargs.get("zt_aggregate", "mean")
 
     mpl.rcParams.update({"font.size": font_size})
 
@@ -262,7 +276,18 @@ def zt(data, **kwargs):
         1, 1, figsize=(5.5 * factor, 4.5 * factor), facecolor="w", edgecolor="k"
     )
 
-    plt.contourf(data.time, data.ALT, data.T, 20, vmin=clim[0], vmax=clim[1])
+    if aggregate is not None:
+        nbins = kwargs.get("zt_bins", None) or int(ax.get_window_extent().width)
+        data = aggregate_time(data, nbins, aggregate)
+
+    # ALT is either a dimension (mean heights) or a 2D coordinate (time-varying heights)
+    tt = data["time"].broadcast_like(data).transpose(*data.dims)
+    zz = data["ALT"].broadcast_like(data).transpose(*data.dims)
+
+    cmap = plt.get_cmap()
+    levels = np.linspace(clim[0], max(clim[1], clim[0] + 1), 21)  # like contourf with 20 levels
+    norm = mpl.colors.BoundaryNorm(levels, cmap.N, extend="both")
+    plt.pcolormesh(tt.T, zz.T, data.T, shading="auto", cmap=cmap, norm=norm, rasterized=True)
 
     cbar = plt.colorbar()
     cbar.set_label("(" + data.units + ")")
@@ -284,46 +309,63 @@ def zt(data, **kwargs):
 
 
 # ----------------------------------------------------------------------------------------------------------------------
-def Windrose(wsp_data, dir_data, wspmax=None, **kwargs):
+def Windrose(wsp_data, dir_data, windrose_tables=None, wspmax=None, **kwargs):
+    """
+    A wind rose per column, drawn from the frequency tables of the data (see prep_windrose_data). The speed bins go
+    up to wspmax (see get_limits_and_labels); the tables are calculated again if they do not have these bins.
+    """
+
     list_of_figs = []
 
     font_size = kwargs.get("font_size", 10)
+    dpi = kwargs.get("dpi", 400)
 
     mpl.rcParams.update({"font.size": font_size})
 
-    for idx in range(0, wsp_data.ndim):
-
-        tmp_ax = WindroseAxes.from_ax()
-
-        wspvec = wsp_data[wsp_data.columns[idx]].values
-        dirvec = dir_data[wsp_data.columns[idx]].values
+    windrose_tables = get_windrose_tables(wsp_data, dir_data, windrose_tables, wspmax)
 
-        # remove nans from the data, for this is problematic
-        mask = np.isnan(dirvec) | np.isnan(wspvec)
-        dirvec = dirvec[~mask]
-        wspvec = wspvec[~mask]
+    for idx, col in enumerate(windrose_tables.column.values):
 
-        if wspmax is None:
-            wspmax = max(wspvec)
-
-        num = np.ceil(wspmax / 10.0)
-        bins = np.arange(0, wspmax + num, num)
+        tmp_ax = WindroseAxes.from_ax()
 
-        tmp_ax.contourf(dirvec, wspvec, bins=bins, cmap=mpl.cm.hot, normed=True, nsector=32)
-        tmp_ax.contour(dirvec, wspvec, bins=bins, colors="black", normed=True, nsector=32)
+        draw_windrose(tmp_ax, windrose_tables.sel(column=col).values, windrose_tables.speed.values)
         tmp_ax.set_xticklabels(["E", "NE", "N", "NW", "W", "SW", "S", "SE"])
 
+        fig = tmp_ax.figure
+
         if idx == 0:
-            tmp_ax.set_legend()
+            # WindroseAxes.legend needs the data of its own plotting methods, so the figure holds the legend.
+            handles, labels = tmp_ax.get_legend_handles_labels()
+            fig.legend(handles[::-1], labels[::-1], loc="lower left", fontsize=8)
 
-        fig = tmp_ax.figure
         fig.set_size_inches((6, 6))
-        fig.set_dpi(400)
+        fig.set_dpi(dpi)
         list_of_figs.append(fig)
 
     return list_of_figs
 
 
+def draw_windrose(ax, table, bins, cmap=mpl.cm.hot):
+    """
+    Draws a frequency table (shape (speed bins, sectors), see calc_windrose_table) on a WindroseAxes like its
+    contourf followed by contour, but without binning the data again. Only the matplotlib API of the axes is used.
+    """
+
+    nbins, nsector = table.shape
+
+    # WindroseAxes keep the orientation of polar axes, so a direction (clockwise from north) is drawn at
+    # 90 - direction. The first sector is repeated to close the lines.
+    angles = np.pi / 2 - np.deg2rad(np.arange(nsector + 1) * 360.0 / nsector)
+    vals = np.cumsum(np.hstack((table, table[:, :1])), axis=0)
+    colors = [cmap(item) for item in np.linspace(0.0, 1.0, nbins)]
+    labels = [f"[{bins[idx]:g} : {bins[idx + 1]:g})" for idx in range(nbins - 1)] + [f">{bins[-1]:g}"]
+
+    # the cumulative frequencies are filled from the outside in, so all speed bins stay visible.
+    for idx in reversed(range(nbins)):
+        ax.fill(angles, vals[idx], facecolor=colors[idx], edgecolor=colors[idx], label=labels[idx])
+        ax.plot(angles, vals[idx], color="black")
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 def Histogram(data, **kwargs):
     font_size = kwargs.get("font_size", 10)
@@ -371,6 +413,40 @@ def Obs_vs_Mod(data, sty=None, col=None, label=None, **kwargs):
     if label is None:
         label = list_of_keys
 
+    quantiles = np.linspace(0.01, 0.99, 99) if kwargs.get("qq", False) else None
+
+    if use_density(data, kwargs.get("density", None), kwargs.get("density_threshold", DENSITY_THRESHOLD)):
+        # Too many points to draw. Show the density of the pairs, one panel per model.
+        plt.close(figure)
+        figure, axes = plt.subplots(
+            1,
+            len(list_of_keys),
+            figsize=(5.5 * factor * len(list_of_keys), 5.5 * factor),
+            squeeze=False,
+            sharey=True,
+            facecolor="w",
+            edgecolor="k",
+        )
+        density = calc_obs_vs_mod_density(data, bins=kwargs.get("bins", 100), lims=xlim, quantiles=quantiles)
+        edges = density["edges"]
+
+        for n, key in enumerate(list_of_keys):
+            ax = axes[0, n]
+            counts = np.ma.masked_equal(density["counts"][key].T, 0)
+            mesh = ax.pcolormesh(edges, edges, counts, norm=mpl.colors.LogNorm(), cmap="viridis")
+            if key in density["qq"]:
+                ax.plot(*density["qq"][key], color="r", ls="", marker=".", label="quantiles")
+            ax.plot(xlim, xlim, "grey", lw=2)
+            ax.set_title(label[n])
+            ax.set_xlabel(xlabel)
+            ax.set_xlim(xlim)
+            ax.set_ylim(ylim)
+
+        axes[0, 0].set_ylabel(ylabel)
+        figure.colorbar(mesh, ax=axes[0, -1], label="count")
+
+        return figure
+
     for n, key in enumerate(list_of_keys):
         ax.plot(
             data[obs_key],
@@ -383,6 +459,12 @@ def Obs_vs_Mod(data, sty=None, col=None, label=None, **kwargs):
             label=label[n],
         )
 
+    if quantiles is not None:
+        density = calc_obs_vs_mod_density(data, bins=1, lims=xlim, quantiles=quantiles)
+        for n, key in enumerate(list_of_keys):
+            if key in density["qq"]:
+                ax.plot(*density["qq"][key], color=col[n], ls="-", lw=1, label=f"{label[n]} (quantiles)")
+
     ax.plot(xlim, xlim, "grey", lw=2)
 
     ax.set_xlabel(xlabel)
@@ -516,11 +598,12 @@ def Map_Cartopy(data: xr.DataArray, hgt=None, ivg=None, pcmesh=False, **kwargs):
 
 
 # ----------------------------------------------------------------------------------------------------------------------
-def Availability(Avail: np.ndarray, zz: float, var: str, year: str, savename=None) -> None:
+def Availability(Avail, zz: float, var: str, year: str, savename=None) -> None:
     """
     Plot data availability
     Args:
-        Avail: Matrix that contains the availability data
+        Avail: Matrix (month x day) that contains the availability data or a table of daily availability of a
+            single year, station and variable (see calc_availability)
         zz: height of the instrument
         var: variable
         year: year
@@ -532,6 +615,11 @@ def Availability(Avail: np.ndarray, zz: float, var: str, year: str, savename=Non
 
     """
 
+    if isinstance(Avail, pd.DataFrame):
+        matrix = np.zeros([12, 31]) * np.nan
+        matrix[Avail["time"].dt.month.values - 1, Avail["time"].dt.day.values - 1] = Avail["availability"].values
+        Avail = matrix
+
     xvec = np.arange(1, 33)
     yvec = np.arange(1, 14)
     xticks = np.arange(5.5, 35.5, 5)
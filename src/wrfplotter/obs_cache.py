@@ -0,0 +1,242 @@
+"""
+A columnar cache of CF-conform observations, for fast repeated reads of the same dataset.
+
+For each dataset, every variable is stored as a contiguous .npy file (time first), which is opened as a memory map.
+All variables share one int64 time index (ns since 1970) and one station index. Metadata (attributes, station
+coordinates and the signature of the source files) is stored in a json file. The cache is rebuilt automatically if
+the source files change.
+
+Every build is written to a new version folder OBSERVATIONS_PATH/<name_of_dataset>/.cache_v<...>. The symlink
+OBSERVATIONS_PATH/<name_of_dataset>/.cache points to the current version and is replaced atomically, so readers see
+either the old or the new cache, never a half-written or a missing one.
+
+Reading a time window is a searchsorted on the time index and a slice of each memory map, so no data is copied.
+The arrays are read-only.
+"""
+
+import datetime as dt
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+CACHE_VERSION = 1
+
+
+def get_cache_path(name_of_dataset: str) -> Path:
+    """The link to the current version of the cache."""
+    return Path(os.environ["OBSERVATIONS_PATH"]) / f"{name_of_dataset}/.cache"
+
+
+def _publish_version(cache_path: Path, version_path: Path) -> None:
+    """
+    Points the link cache_path to version_path (atomically, with os.replace) and removes all older versions.
+    Versions are named by the time they were finished. If several processes build the cache at the same time, the
+    newest version wins; a builder that finishes earlier but publishes later discards its version.
+    """
+
+    if cache_path.is_dir() and not cache_path.is_symlink():
+        shutil.rmtree(cache_path)  # cache of an older layout (a plain folder)
+
+    if cache_path.is_symlink() and os.readlink(cache_path) > version_path.name:
+        shutil.rmtree(version_path, ignore_errors=True)
+        return
+
+    tmp_link = cache_path.parent / f".cache_link_{os.getpid()}_{time.time_ns()}"
+    os.symlink(version_path.name, tmp_link)
+    os.replace(tmp_link, cache_path)
+
+    # A reader may still use an old version. Open memory maps stay valid when the files are removed and readers
+    # retry once with the current version, see read_obs_cache.
+    for path in cache_path.parent.glob(".cache_v*"):
+        if path.name < version_path.name:
+            shutil.rmtree(path, ignore_errors=True)
+
+    if not version_path.is_dir():
+        # removed by a newer build, which published in between. Point to the newest version again.
+        versions = sorted(cache_path.parent.glob(".cache_v*"))
+        if len(versions) > 0:
+            _publish_version(cache_path, versions[-1])
+
+
+def get_source_signature(name_of_dataset: str) -> list:
+    """
+    Name, size and modification time of all CF-conform files of a dataset. If any of these changes, the cache
+    is outdated.
+    """
+
+    filepath = Path(os.environ["OBSERVATIONS_PATH"]) / f"{name_of_dataset}/"
+    list_of_files = sorted(filepath.glob(f"{name_of_dataset}*.nc"))
+
+    signature = []
+    for filename in list_of_files:
+        stat = filename.stat()
+        signature.append([filename.name, stat.st_size, stat.st_mtime_ns])
+
+    return signature
+
+
+def _to_json(attrs: dict) -> dict:
+    # numpy types are not json serializable.
+    new_attrs = dict()
+    for key, value in attrs.items():
+        if isinstance(value, (np.ndarray, np.generic)):
+            value = value.tolist()
+        new_attrs[key] = value
+    return new_attrs
+
+
+def build_obs_cache(name_of_dataset: str, chunksize=100000, verbose=False) -> None:
+    """
+    (Re)builds the cache of a dataset from all of its CF-conform files.
+
+    The data is written variable by variable in chunks of chunksize time steps, so the dataset does not have to fit
+    in memory. The cache is built in a temporary folder, which becomes a new version and is published by replacing
+    the link .cache atomically, so readers never see a half-written cache. If several processes build the cache at
+    the same time, the last one wins; all of them publish a complete cache.
+
+    Args:
+        name_of_dataset: the name of the dataset
+        chunksize: number of time steps that are written at once
+        verbose: if True, speak with user
+
+    Returns: None
+
+    """
+
+    from wrfplotter.wrfplotter_classes import merge_cfconform_files
+
+    signature = get_source_signature(name_of_dataset)
+    if len(signature) == 0:
+        if verbose:
+            print(f"No files found for dataset {name_of_dataset}")
+        return
+
+    cache_path = get_cache_path(name_of_dataset)
+    tmp_path = cache_path.parent / f".cache_tmp_{os.getpid()}_{time.time_ns()}"
+    os.mkdir(tmp_path)
+
+    filenames = [cache_path.parent / item[0] for item in signature]
+    data = merge_cfconform_files(filenames)
+
+    if verbose:
+        print(f"Building cache for {name_of_dataset} ({data.sizes['time']} time steps)")
+
+    meta = dict()
+    meta["version"] = CACHE_VERSION
+    meta["signature"] = signature
+    meta["attrs"] = _to_json(data.attrs)
+    meta["time_attrs"] = _to_json(data["time"].attrs)
+
+    if "station_name" in data.dims:
+        meta["station_name"] = [str(item) for item in data["station_name"].values]
+    else:
+        meta["station_name"] = None
+
+    # Variables without a time dimension (lat, lon, station_elevation...) are small. Keep them in the json file.
+    meta["static"] = dict()
+    for name, item in data.variables.items():
+        if "time" not in item.dims and name != "station_name":
+            meta["static"][name] = {
+                "dims": list(item.dims),
+                "values": np.asarray(item.values).tolist(),
+                "attrs": _to_json(item.attrs),
+                "coord": name in data.coords,
+            }
+
+    np.save(tmp_path / "time.npy", data.indexes["time"].values.astype("datetime64[ns]").astype(np.int64))
+
+    meta["variables"] = dict()
+    ntime = data.sizes["time"]
+    for name, item in data.data_vars.items():
+        if "time" not in item.dims or not np.issubdtype(item.dtype, np.number):
+            continue
+
+        dims = ["time"] + [dim for dim in item.dims if dim != "time"]
+        item = item.transpose(*dims)
+
+        mmap = np.lib.format.open_memmap(tmp_path / f"{name}.npy", mode="w+", dtype=item.dtype, shape=item.shape)
+        for start in range(0, ntime, chunksize):
+            mmap[start:start + chunksize] = item.isel(time=slice(start, start + chunksize)).values
+        mmap.flush()
+        del mmap
+
+        meta["variables"][name] = {"dims": dims, "attrs": _to_json(item.attrs)}
+
+    with open(tmp_path / "meta.json", "w") as f:
+        json.dump(meta, f)
+
+    data.close()
+
+    # versions are named by the time they are finished, so later versions sort last.
+    version_path = cache_path.parent / f".cache_v{time.time_ns():020d}_{os.getpid()}"
+    os.rename(tmp_path, version_path)
+    _publish_version(cache_path, version_path)
+
+
+def is_cache_valid(name_of_dataset: str) -> bool:
+    metafile = get_cache_path(name_of_dataset) / "meta.json"
+    if not metafile.is_file():
+        return False
+
+    with open(metafile, "r") as f:
+        meta = json.load(f)
+
+    return meta.get("version") == CACHE_VERSION and meta["signature"] == get_source_signature(name_of_dataset)
+
+
+def read_obs_cache(name_of_dataset: str, dtstart: dt.datetime, dtend: dt.datetime, verbose=False) -> xr.Dataset:
+    """
+    Reads the time window [dtstart, dtend] of a dataset from the cache. The cache is (re)built if it does not
+    exist or if the source files have changed.
+
+    Args:
+        name_of_dataset: the name of the dataset
+        dtstart: start of the time window
+        dtend: end of the time window
+        verbose: if True, speak with user
+
+    Returns: a dataset, whose variables are read-only views of the memory maps.
+
+    """
+
+    if not is_cache_valid(name_of_dataset):
+        build_obs_cache(name_of_dataset, verbose=verbose)
+
+    try:
+        return _read_cache_version(get_cache_path(name_of_dataset).resolve(), dtstart, dtend)
+    except FileNotFoundError:
+        # the version was replaced and removed by a concurrent build while reading it.
+        return _read_cache_version(get_cache_path(name_of_dataset).resolve(), dtstart, dtend)
+
+
+def _read_cache_version(cache_path: Path, dtstart, dtend) -> xr.Dataset:
+    with open(cache_path / "meta.json", "r") as f:
+        meta = json.load(f)
+
+    tvec = np.load(cache_path / "time.npy", mmap_mode="r")
+    first = np.searchsorted(tvec, pd.Timestamp(dtstart).value, side="left")
+    last = np.searchsorted(tvec, pd.Timestamp(dtend).value, side="right")
+
+    coords = dict()
+    coords["time"] = xr.Variable("time", tvec[first:last].view("datetime64[ns]"), meta["time_attrs"])
+    if meta["station_name"] is not None:
+        coords["station_name"] = meta["station_name"]
+
+    data_vars = dict()
+    for name, item in meta["static"].items():
+        variable = xr.Variable(item["dims"], np.asarray(item["values"]), item["attrs"])
+        if item["coord"]:
+            coords[name] = variable
+        else:
+            data_vars[name] = variable
+
+    for name, item in meta["variables"].items():
+        mmap = np.load(cache_path / f"{name}.npy", mmap_mode="r")
+        data_vars[name] = xr.Variable(item["dims"], mmap[first:last], item["attrs"])
+
+    return xr.Dataset(data_vars, coords=coords, attrs=meta["attrs"])
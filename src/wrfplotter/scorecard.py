@@ -0,0 +1,202 @@
+"""
+Batch verification of many experiments against observations.
+
+The scorecard evaluates every combination of station, height, variable and experiment for which observations and
+model data exist and collects the statistics (see wrfplotter.statistics) in a single tidy table. The model data is
+interpolated once per station, experiment and variable to all observed heights (with the cached weights of
+interpolate_to_heights). Stations are processed in parallel.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import pandas as pd
+import xarray as xr
+from wrfplotter.load_and_prepare import interpolate_to_heights, load_mod_data, StationView
+from wrfplotter.statistics import calc_statistics
+from wrfplotter.variable_index import get_device, get_variable_index
+
+SCORECARD_COLUMNS = ["station", "variable", "device", "height", "experiment"]
+
+
+def calc_station_scorecard(station: str, obs: xr.Dataset, mod_data: dict, variables, anemometer="Sonic") -> list:
+    """
+    The scorecard of a single station.
+
+    Args:
+        station: name of the station
+        obs: observations of the station
+        mod_data: dict of model data (mod_data[exp][station], see load_mod_data)
+        variables: list of variables, i.e. ["WSP", "DIR"]
+        anemometer: Sonic or Analog
+
+    Returns: a list of tables, see calc_scorecard
+
+    """
+
+    index = get_variable_index(obs)
+    expvec = [exp for exp in mod_data if station in mod_data[exp]]
+
+    all_tables = []
+    for var in variables:
+        device = get_device(var, anemometer)
+        heights = index.heights(var, device)
+        if len(heights) == 0:
+            continue
+
+        # all heights of all experiments at once.
+        interp = dict()
+        for exp in expvec:
+            mymod = mod_data[exp][station]
+            if var not in mymod:
+                continue
+            mod_vars = [var] + [item for item in ["U", "V"] if var == "DIR" and item in mymod]
+            interp[exp] = interpolate_to_heights(mymod, mod_vars, heights, key=(exp, station))[var]
+
+        if len(interp) == 0:
+            continue
+
+        for idx, height in enumerate(heights):
+            # scalar coordinates (station_name, lat, lon...) of obs and models may differ
+            data = {"obs": obs[index.name(var, device, height)].reset_coords(drop=True)}
+            for exp, item in interp.items():
+                data[exp] = item.isel(height=idx).reset_coords(drop=True)
+            data = xr.Dataset(data)
+
+            table = calc_statistics(data, obs="obs", models=list(interp), var=var).reset_index()
+            table = table.rename(columns={"model": "experiment"})
+            table.insert(0, "station", station)
+            table.insert(1, "variable", var)
+            table.insert(2, "device", device)
+            table.insert(3, "height", height)
+            all_tables.append(table)
+
+    return all_tables
+
+
+def calc_scorecard(
+    obs_data: dict, mod_data: dict, variables=("WSP", "DIR"), anemometer="Sonic", max_workers=None
+) -> pd.DataFrame:
+    """
+    Statistics of all experiments at all stations, heights and variables, in parallel over stations.
+
+    Args:
+        obs_data: dict of observations per station
+        mod_data: dict of model data per experiment (mod_data[exp][station], see load_mod_data)
+        variables: list of variables
+        anemometer: Sonic or Analog
+        max_workers: number of threads
+
+    Returns: a tidy table with the columns station, variable, device, height, experiment and the statistics
+
+    """
+
+    def run(station):
+        return calc_station_scorecard(station, obs_data[station], mod_data, variables, anemometer)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        all_tables = [table for tables in executor.map(run, list(obs_data)) for table in tables]
+
+    if len(all_tables) == 0:
+        return pd.DataFrame(columns=SCORECARD_COLUMNS)
+
+    return pd.concat(all_tables, ignore_index=True)
+
+
+def write_scorecard(table: pd.DataFrame, filename) -> None:
+    """
+    Writes the scorecard to a netCDF (.nc) or a Parquet (.parquet, needs pyarrow or fastparquet) file.
+    """
+
+    filename = Path(filename)
+    if filename.suffix == ".parquet":
+        table.to_parquet(filename, index=False)
+    elif filename.suffix == ".nc":
+        data = xr.Dataset.from_dataframe(table.rename_axis("row"))
+        for name in ["station", "variable", "device", "experiment"]:
+            data[name] = data[name].astype(str)
+        data.to_netcdf(filename)
+    else:
+        print(f"Cannot write {filename}. Use .nc or .parquet")
+        raise ValueError
+
+
+def load_obs_stations(dataset: str, dtstart, dtend, ave_window=None, split=None) -> dict:
+    """
+    All stations of an observation dataset within [dtstart, dtend] as a dict of datasets. ave_window: see
+    select_rollup, split: see get_list_of_filenames.
+    """
+
+    from wrfplotter.wrfplotter_classes import Timeseries
+
+    ts = Timeseries(dataset)
+    ts.read_cfconform_data(dtstart, dtend, calc_pt=True, split=split, ave_window=ave_window)
+    data = ts.data.sel(time=slice(dtstart, dtend))  # whole files are read
+
+    if "station_name" in data.dims:
+        return {str(stat): data.isel(station_name=idx) for idx, stat in enumerate(data.station_name.values)}
+    if "station_name" in data.coords:
+        return {str(data.station_name.values): data}
+    return {dataset: data}
+
+
+def run_scorecard(
+    proj_name,
+    expvec: list,
+    datasets: list,
+    dom: str,
+    dtstart,
+    dtend,
+    ave_window="raw",
+    variables=("WSP", "DIR"),
+    anemometer="Sonic",
+    outfile=None,
+    max_workers=None,
+    obs_ave_window=None,
+    split=None,
+    verbose=False,
+) -> pd.DataFrame:
+    """
+    Loads the model data of all experiments of a project and the observation datasets and calculates the
+    scorecard (see calc_scorecard). Stations are matched by name.
+
+    Args:
+        proj_name: name of the project
+        expvec: list of experiments
+        datasets: list of observation datasets
+        dom: domain, i.e. d01
+        dtstart: start of the evaluation
+        dtend: end of the evaluation
+        ave_window: averaging window of the model data in minutes (see open_averaged_tslist)
+        variables: list of variables
+        anemometer: Sonic or Analog
+        outfile: if given, the table is written to this file (see write_scorecard)
+        max_workers: number of threads
+        obs_ave_window: averaging window of the observations in minutes (see select_rollup). None for raw data.
+        split: how the observation datasets are split into files, YS, MS or None (see get_list_of_filenames)
+        verbose: if True, speak with user
+
+    Returns: the scorecard
+
+    """
+
+    obs_data = dict()
+    for dataset in datasets:
+        obs_data.update(load_obs_stations(dataset, dtstart, dtend, obs_ave_window, split))
+
+    mod_data = dict()
+    for exp in expvec:
+        load_mod_data(mod_data, exp, verbose=verbose, proj_name=proj_name, dom=dom, AveChoice_WRF=ave_window)
+
+    # only the time window is evaluated.
+    mod_data = {exp: StationView(view.data.sel(time=slice(dtstart, dtend))) for exp, view in mod_data.items()}
+
+    obs_data = {stat: data for stat, data in obs_data.items() if any(stat in item for item in mod_data.values())}
+    if verbose:
+        print(f"Evaluating {len(mod_data)} experiments at {len(obs_data)} stations")
+
+    table = calc_scorecard(obs_data, mod_data, variables, anemometer, max_workers)
+
+    if outfile is not None:
+        write_scorecard(table, outfile)
+
+    return table
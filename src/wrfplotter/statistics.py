@@ -0,0 +1,161 @@
+"""
+Verification statistics of model data against observations.
+
+The statistics of all models are calculated at once from sums (number of valid pairs, sums of the values, of their
+squares and products and of the differences). Sums of different chunks of data can simply be added, so the data can
+be processed in chunks (pandas) or lazily (dask) and the partial results are merged afterwards.
+
+For the wind direction (DIR), differences are wrapped to [-180, 180) degrees and the mean and standard deviation are
+circular.
+"""
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+COLUMNS = ["N", "Mean Obs", "Mean Mod", "Bias", "MAE", "RMSE", "R", "Std Ratio"]
+
+
+def is_circular(var) -> bool:
+    return var is not None and str(var).startswith("DIR")
+
+
+def calc_partial_sums(obs, mod, circular=False) -> dict:
+    """
+    Sums of a chunk of data, for all models at once.
+
+    Args:
+        obs: observations, shape (time,); a numpy or a dask array
+        mod: models, shape (time, number of models); a numpy or a dask array
+        circular: if True, the data are directions in degree
+
+    Returns: a dict of sums, each of shape (number of models,). Lazy for dask arrays.
+
+    """
+
+    obs = obs[:, None]
+    valid = ~np.isnan(obs) & ~np.isnan(mod)
+    obs = np.where(valid, obs, 0.0)
+    mod = np.where(valid, mod, 0.0)
+
+    diff = mod - obs
+    if circular:
+        diff = np.mod(diff + 180.0, 360.0) - 180.0
+
+    sums = {"n": valid.sum(axis=0), "diff": diff.sum(axis=0), "absdiff": abs(diff).sum(axis=0)}
+    sums["diff2"] = (diff ** 2).sum(axis=0)
+
+    if circular:
+        # only valid pairs contribute to the sums of sin and cos
+        sums["sin_obs"] = np.where(valid, np.sin(np.deg2rad(obs)), 0.0).sum(axis=0)
+        sums["cos_obs"] = np.where(valid, np.cos(np.deg2rad(obs)), 0.0).sum(axis=0)
+        sums["sin_mod"] = np.where(valid, np.sin(np.deg2rad(mod)), 0.0).sum(axis=0)
+        sums["cos_mod"] = np.where(valid, np.cos(np.deg2rad(mod)), 0.0).sum(axis=0)
+    else:
+        sums["obs"] = obs.sum(axis=0)
+        sums["mod"] = mod.sum(axis=0)
+        sums["obs2"] = (obs ** 2).sum(axis=0)
+        sums["mod2"] = (mod ** 2).sum(axis=0)
+        sums["obsmod"] = (obs * mod).sum(axis=0)
+
+    return sums
+
+
+def merge_partial_sums(list_of_sums: list) -> dict:
+    """Merges the sums of several chunks (see calc_partial_sums)."""
+
+    merged = dict()
+    for sums in list_of_sums:
+        for key, value in sums.items():
+            merged[key] = merged[key] + value if key in merged else value
+
+    return merged
+
+
+def finalize_statistics(sums: dict, models: list, circular=False) -> pd.DataFrame:
+    """
+    The statistics from the (merged) sums.
+
+    Args:
+        sums: see calc_partial_sums. Must be computed (not lazy).
+        models: names of the models
+        circular: if True, the data are directions in degree
+
+    Returns: a table with a row per model and the columns N, Mean Obs, Mean Mod, Bias, MAE, RMSE, R and Std Ratio
+
+    """
+
+    sums = {key: np.asarray(value, dtype=float) for key, value in sums.items()}
+    n = sums["n"]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        table = {
+            "N": n.astype(int),
+            "Bias": sums["diff"] / n,
+            "MAE": sums["absdiff"] / n,
+            "RMSE": np.sqrt(sums["diff2"] / n),
+        }
+
+        if circular:
+            mean, std = dict(), dict()
+            for item in ["obs", "mod"]:
+                ssum, csum = sums[f"sin_{item}"] / n, sums[f"cos_{item}"] / n
+                mean[item] = np.mod(np.rad2deg(np.arctan2(ssum, csum)), 360)
+                std[item] = np.sqrt(-2 * np.log(np.minimum(np.sqrt(ssum ** 2 + csum ** 2), 1)))
+            table["R"] = np.full(n.shape, np.nan)  # no linear correlation for directions
+        else:
+            mean = {"obs": sums["obs"] / n, "mod": sums["mod"] / n}
+            std = {item: np.sqrt(np.maximum(sums[f"{item}2"] / n - mean[item] ** 2, 0)) for item in ["obs", "mod"]}
+            table["R"] = (sums["obsmod"] / n - mean["obs"] * mean["mod"]) / (std["obs"] * std["mod"])
+
+        table["Mean Obs"] = mean["obs"]
+        table["Mean Mod"] = mean["mod"]
+        table["Std Ratio"] = std["mod"] / std["obs"]
+
+    return pd.DataFrame(table, index=pd.Index(models, name="model"))[COLUMNS]
+
+
+def calc_statistics(data, obs=None, models=None, var=None, chunksize=None) -> pd.DataFrame:
+    """
+    Verification statistics of all models against an observation.
+
+    Args:
+        data: a DataFrame (i.e. from prep_ts_data) or a Dataset (numpy or dask) with a column/variable per
+            observation and model.
+        obs: name of the observation; the first column by default
+        models: list of models; all other columns by default
+        var: the variable. Circular statistics are used for DIR.
+        chunksize: for DataFrames, number of rows that are processed at once. All at once by default.
+
+    Returns: see finalize_statistics
+
+    """
+
+    columns = list(data.columns) if isinstance(data, pd.DataFrame) else list(data.data_vars)
+    if obs is None:
+        obs = columns[0]
+    if models is None:
+        models = [item for item in columns if item != obs]
+
+    circular = is_circular(var)
+
+    if isinstance(data, xr.Dataset):
+        obs_values = data[obs].data
+        mod_values = xr.concat([data[item] for item in models], dim="model").transpose(..., "model").data
+        sums = calc_partial_sums(obs_values, mod_values, circular)
+        if hasattr(mod_values, "dask"):
+            import dask
+
+            keys = list(sums)
+            sums = dict(zip(keys, dask.compute(*[sums[key] for key in keys])))
+    else:
+        chunksize = chunksize or max(len(data), 1)
+        obs_values = data[obs].to_numpy(dtype=float)
+        mod_values = data[models].to_numpy(dtype=float)
+        all_sums = []
+        for start in range(0, max(len(data), 1), chunksize):
+            chunk = slice(start, start + chunksize)
+            all_sums.append(calc_partial_sums(obs_values[chunk], mod_values[chunk], circular))
+        sums = merge_partial_sums(all_sums)
+
+    return finalize_statistics(sums, models, circular)
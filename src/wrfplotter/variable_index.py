@@ -0,0 +1,141 @@
+"""
+An index of the variables of an observation dataset, parsed from their names.
+
+Observations follow the naming convention <variable>[_<device>]_<height>[_<statistic>], i.e. WSP_USA_100, DIR_VANE_92,
+T_10 or WSP_USA_100_std (a statistic of a rollup, see Timeseries.build_rollups). The index maps
+(variable, device, height, statistic) to the name of the variable and its units. It is built once per schema (the
+names and units of all variables) and shared between all datasets with the same schema. The index of each dataset
+object is remembered, so repeated lookups on the same dataset do not scan its variables again.
+"""
+
+import weakref
+from functools import lru_cache
+import numpy as np
+import xarray as xr
+
+# devices of the anemometers, as used in the names of the variables
+DEVICES = {
+    "WSP": {"Sonic": "USA", "Analog": "CUP"},
+    "DIR": {"Sonic": "USA", "Analog": "VANE"},
+}
+
+STATISTICS = ("std", "min", "max", "count")
+
+# index by id of the dataset: (weak reference to the dataset, number of variables, index)
+_dataset_indexes = dict()
+
+
+def get_device(var: str, anemometer: str) -> str:
+    return DEVICES.get(var, dict()).get(anemometer, "")
+
+
+def parse_name(name: str):
+    """
+    Splits the name of a variable into (variable, device, height, statistic).
+
+    Args:
+        name: i.e. WSP_USA_100
+
+    Returns: the tuple, or None if the name does not follow the naming convention.
+
+    """
+
+    parts = name.split("_")
+
+    statistic = None
+    if len(parts) > 2 and parts[-1] in STATISTICS:
+        statistic = parts.pop()
+    if "std" in parts[1:]:  # old convention, i.e. WSP_USA_std_100
+        parts.remove("std")
+        statistic = "std"
+
+    if len(parts) < 2:
+        return None
+
+    try:
+        height = float(parts[-1])
+    except ValueError:
+        return None
+
+    return parts[0], "_".join(parts[1:-1]), height, statistic
+
+
+class VariableIndex:
+    """
+    Variables of a dataset by (variable, device, height, statistic). Use get_variable_index to get the (cached)
+    index of a dataset.
+    """
+
+    def __init__(self, schema: tuple):
+        self.entries = dict()
+        self.units = dict()
+        self._heights = dict()
+
+        for name, units in schema:
+            self.units[name] = units
+            parsed = parse_name(name)
+            if parsed is None:
+                continue
+            self.entries[parsed] = name
+            self._heights.setdefault((parsed[0], parsed[1], parsed[3]), []).append(parsed[2])
+
+        self._heights = {key: np.sort(value) for key, value in self._heights.items()}
+
+    def heights(self, var: str, device="", statistic=None) -> np.ndarray:
+        """All heights of a variable, measured by device, sorted."""
+        return self._heights.get((var, device, statistic), np.array([]))
+
+    def name(self, var: str, device: str, height, statistic=None) -> str:
+        """The name of a variable at a height. Raises a KeyError if it does not exist."""
+        try:
+            height = float(height)
+        except (TypeError, ValueError):
+            raise KeyError(f"{var} at height {height}")
+
+        return self.entries[(var, device, height, statistic)]
+
+    def closest(self, var: str, device: str, height, statistic=None) -> (str, float):
+        """The name and height of the variable closest to height. Raises a KeyError if the variable does not exist."""
+        heights = self.heights(var, device, statistic)
+        if len(heights) == 0:
+            raise KeyError(f"{var} ({device})")
+
+        height = heights[np.argmin(np.abs(heights - float(height)))]
+
+        return self.entries[(var, device, height, statistic)], height
+
+
+@lru_cache(maxsize=64)
+def _build_index(schema: tuple) -> VariableIndex:
+    return VariableIndex(schema)
+
+
+def _forget_dataset(ref, key):
+    if _dataset_indexes.get(key, (None,))[0] is ref:
+        _dataset_indexes.pop(key, None)
+
+
+def get_variable_index(data: xr.Dataset) -> VariableIndex:
+    """
+    The index of a dataset. Datasets with the same variables (names and units) share the index. The index of a
+    dataset object is reused as long as the number of its variables does not change. Units must not be changed in
+    place once the index was taken.
+
+    Args:
+        data: the dataset
+
+    Returns: the index
+
+    """
+
+    key = id(data)
+    nvars = len(data.variables)
+    entry = _dataset_indexes.get(key)
+    if entry is not None and entry[0]() is data and entry[1] == nvars:
+        return entry[2]
+
+    schema = tuple((name, item.attrs.get("units")) for name, item in data.data_vars.items())
+    index = _build_index(schema)
+    _dataset_indexes[key] = (weakref.ref(data, lambda ref: _forget_dataset(ref, key)), nvars, index)
+
+    return index
@@ -1,5 +1,5 @@
 import matplotlib.pyplot as plt
-from netCDF4 import Dataset
+from netCDF4 import Dataset, num2date, date2num
 import numpy as np
 import pandas as pd
 import wrf
@@ -7,11 +7,15 @@ import xarray as xr
 import datetime as dt
 from pathlib import PosixPath, Path
 import os
+import shutil
 import yaml
 from typing import Union
+from concurrent.futures import ProcessPoolExecutor
 from wrfplotter.mpl_plots import Availability, Map_Cartopy
 from wrfplotter.hv_plots import Map_hvplots
 from wrfplotter.load_and_prepare import get_limits_and_labels
+from wrfplotter.obs_cache import read_obs_cache
+from wrfplotter.variable_index import get_variable_index
 
 
 class Map:
@@ -357,7 +361,14 @@ def get_list_of_filenames(name_of_dataset: str, dtstart: dt.datetime, dtend: dt.
     if split is None:
         tvec = pd.date_range(start=dtstart2, end=dtend2, periods=2)
     else:
-        tvec = pd.date_range(start=dtstart2, end=dtend2, freq=split)
+        # Extend to full periods, so that data which lies within a single period (e.g. a day of data that is added
+        # to a yearly file) is still assigned to a file.
+        offset = pd.tseries.frequencies.to_offset(split)
+        tstart = offset.rollback(pd.Timestamp(dtstart2))
+        tend = offset.rollforward(pd.Timestamp(dtend2))
+        if tend < pd.Timestamp(dtend) or tend <= tstart:
+            tend = tend + offset
+        tvec = pd.date_range(start=tstart, end=tend, freq=split)
 
     filenames = [filepath / f"{name_of_dataset}_{tvec[idx].strftime('%Y%m%d')}_{tvec[idx + 1].strftime('%Y%m%d')}.nc"
                  for idx in range(0, len(tvec) - 1)]
@@ -394,6 +405,547 @@ def get_max_timerange(name_of_dataset):
     return tvec
 
 
+def read_cf_table(cf_table=None) -> dict:
+    """
+    Reads the table of CF attributes.
+
+    Args:
+        cf_table: path to a yaml file. If None, resources/cf_table_timeseries_fields.yaml is used.
+
+    Returns: a dict that maps variable names to a dict of attributes.
+
+    """
+
+    if cf_table is None:
+        cf_table = os.path.split(os.path.realpath(__file__))[0] + "/resources/cf_table_timeseries_fields.yaml"
+
+    with open(cf_table, "r") as f:
+        table = yaml.safe_load(f)
+
+    return table
+
+
+def assign_cf_attributes_tslist(data: xr.Dataset, metadata: dict, cf_table: Union[str, PosixPath, dict],
+                                old_attrs=None, verbose=False) -> xr.Dataset:
+    """
+    Assigns attributes to timeseries data, so that it is conform with the CF-conventions and this class.
+
+    Args:
+        data: the dataset
+        metadata: a dict of attributes. station_name, lat, lon and station_elevation are stored as coordinates,
+            everything else as global attributes.
+        cf_table: path to the table of CF attributes or the table itself (see read_cf_table). Pass the table if this
+            function is called for many files, so the yaml file is parsed only once.
+            If a variable is not found by its full name, the part before the first underscore is used,
+            i.e. WSP for WSP_USA_100.
+        old_attrs: a list of attributes that should be removed.
+        verbose: if True, speak with user
+
+    Returns: the dataset with CF attributes
+
+    """
+
+    if not isinstance(cf_table, dict):
+        cf_table = read_cf_table(cf_table)
+    if old_attrs is None:
+        old_attrs = []
+
+    metadata = metadata.copy()
+    station_coords = dict()
+    for key in ["station_name", "lat", "lon", "station_elevation"]:
+        if key in metadata:
+            station_coords[key] = xr.DataArray(metadata.pop(key), attrs=cf_table.get(key, dict()))
+
+    for name in data.variables:
+        attrs = cf_table.get(name, cf_table.get(str(name).split("_")[0], None))
+        if attrs is not None:
+            data[name].attrs.update(attrs)
+        elif verbose and name not in data.dims:
+            print(f"No CF attributes found for variable {name}")
+
+        for attr in old_attrs:
+            data[name].attrs.pop(attr, None)
+
+    data = data.assign_coords(station_coords)
+    data.attrs.update(metadata)
+    for attr in old_attrs:
+        data.attrs.pop(attr, None)
+
+    return data
+
+
+def _get_metadata_per_file(meta_table: pd.DataFrame, metadata: dict, nfiles: int) -> list:
+    """
+    Combines the meta_table (either a single line or one line per file) with metadata. Returns one dict per file.
+    """
+
+    if len(meta_table) not in [1, nfiles]:
+        print("meta_table must have a single line or one line per file.")
+        raise ValueError
+
+    all_metadata = []
+    for idx in range(0, nfiles):
+        row = meta_table.iloc[idx if len(meta_table) > 1 else 0]
+        file_metadata = metadata.copy()
+        file_metadata["station_name"] = row.name
+        file_metadata["lat"] = row.lat
+        file_metadata["lon"] = row.lon
+        file_metadata["station_elevation"] = row.elev
+        all_metadata.append(file_metadata)
+
+    return all_metadata
+
+
+def _convert_non_conform_file(filename, translator: dict, metadata: dict, cf_table: dict, old_attrs: list,
+                              verbose: bool) -> xr.Dataset:
+    # Top level function, so it can be used by a pool of workers.
+    data = xr.load_dataset(filename)
+    data = data.rename(translator)
+    data = assign_cf_attributes_tslist(data, metadata, cf_table, old_attrs, verbose)
+    return data
+
+
+def _get_timerange(filename, timename="time") -> tuple:
+    with xr.open_dataset(filename) as data:
+        tvec = data[timename].values
+    return tvec.min(), tvec.max()
+
+
+def _combine_batch(batch: list) -> xr.Dataset:
+    """
+    Combines datasets of one or more stations to a single dataset with the dimensions (time, station_name).
+    """
+
+    per_station = dict()
+    for data in batch:
+        per_station.setdefault(str(data["station_name"].values), []).append(data)
+
+    all_stations = []
+    for items in per_station.values():
+        data = xr.concat(items, dim="time").sortby("time")
+        _, index = np.unique(data["time"], return_index=True)
+        all_stations.append(data.isel(time=index))
+
+    return xr.concat(all_stations, dim="station_name", coords="all")
+
+
+def get_cfconform_encoding(data: xr.Dataset):
+    """
+    Encoding used for all CF-conform files written by the Timeseries class.
+
+    Time is stored as seconds since 1970 (float64) along an unlimited dimension. The same holds for station_name
+    (if it is a dimension). This way, new time records and new stations can be appended to an existing file in place.
+
+    Args:
+        data: the dataset to be written
+
+    Returns: encoding, unlimited_dims (to be passed to to_netcdf)
+
+    """
+
+    encoding = {"time": {"units": "seconds since 1970-01-01 00:00:00", "dtype": "float64"}}
+    unlimited_dims = ["time"]
+    if "station_name" in data.dims:
+        unlimited_dims.append("station_name")
+
+    return encoding, unlimited_dims
+
+
+def append_to_cfconform_file(targetfile: Union[str, PosixPath], data: xr.Dataset, concat_dim="time",
+                             verbose=False) -> bool:
+    """
+    Appends data to an existing CF-conform file in place, i.e. without reading and rewriting the whole file.
+
+    concat_dim == "time": new time records are written to the unlimited time dimension. Times that already exist
+    in the file are skipped (the data in the file is kept).
+    concat_dim == "station_name": new stations are written to the unlimited station_name dimension and aligned
+    with the time axis of the file. Stations that already exist in the file are skipped, unless they bring times
+    the file does not have. These records are appended along time.
+
+    Records can only be appended after the last time of the file. If new times fall within the time range of the
+    file, or the new data has variables or dimensions the file does not have, nothing is written and False is
+    returned. The caller must then rewrite the file.
+
+    Args:
+        targetfile: the CF-conform file
+        data: the data to append
+        concat_dim: time or station_name
+        verbose: if True, speak with user
+
+    Returns: True if the data has been appended (or there was nothing to append), False otherwise.
+
+    """
+
+    if concat_dim not in ["time", "station_name"]:
+        return False
+
+    # drop duplicates within the new data. This also sorts the new data in time, which the split below relies on.
+    _, index = np.unique(data["time"], return_index=True)
+    data = data.isel(time=index)
+
+    with Dataset(targetfile, "a") as fid:
+
+        if "time" not in fid.dimensions or not fid.dimensions["time"].isunlimited():
+            return False
+
+        tvar = fid["time"]
+        calendar = getattr(tvar, "calendar", "standard")
+        ntime = fid.dimensions["time"].size
+
+        has_stations = "station_name" in fid.dimensions
+        if has_stations != ("station_name" in data.dims):
+            return False
+
+        if concat_dim == "station_name":
+            if not has_stations or not fid.dimensions["station_name"].isunlimited():
+                return False
+
+            file_stations = [str(item) for item in fid["station_name"][:]]
+            new_stations = [item for item in data.station_name.values if str(item) not in file_stations]
+            has_existing = len(new_stations) < data.sizes["station_name"]
+
+            # Existing stations with times the file does not have must not be skipped. Without new stations, their
+            # records are appended along time. Otherwise, the caller must merge the data.
+            if has_existing and (ntime == 0 or not _times_in_file(tvar, data.indexes["time"], calendar)):
+                if len(new_stations) > 0:
+                    return False
+                concat_dim = "time"
+            else:
+                if has_existing and verbose:
+                    print(f"Skipping stations that already exist in {targetfile}")
+                if len(new_stations) == 0:
+                    return True
+                data = data.sel(station_name=new_stations)
+
+        if concat_dim == "time" and has_stations:
+            file_stations = [str(item) for item in fid["station_name"][:]]
+            if any(str(item) not in file_stations for item in data.station_name.values):
+                return False
+            data = data.reindex(station_name=file_stations)
+
+        times = data.indexes["time"]
+        if concat_dim == "time":
+            # Only the last time of the file is decoded. Records up to this time must already exist in the file.
+            first = 0
+            if ntime > 0:
+                last_time = num2date(tvar[ntime - 1], tvar.units, calendar,
+                                     only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+                first = times.searchsorted(pd.Timestamp(last_time), side="right")
+
+            if first > 0 and not _times_in_file(tvar, times[:first], calendar):
+                if verbose:
+                    print(f"New records overlap with the time range of {targetfile}")
+                return False
+
+            if verbose and first > 0:
+                print(f"Skipping {first} records that already exist in {targetfile}")
+            new_times = times[first:]
+            if len(new_times) == 0:
+                return True
+            data = data.isel(time=slice(first, None))
+
+        else:
+            # new stations are aligned with the whole time axis of the file.
+            file_times = num2date(tvar[:], tvar.units, calendar,
+                                  only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+            file_times = pd.DatetimeIndex(file_times).astype("datetime64[ns]")
+            new_times = times[~times.isin(file_times)]
+
+            if len(file_times) > 0 and len(new_times) > 0 and new_times[0] <= file_times[-1]:
+                if verbose:
+                    print(f"New records overlap with the time range of {targetfile}")
+                return False
+
+        new_tnum = date2num(new_times.to_pydatetime(), tvar.units, calendar)
+        if np.issubdtype(tvar.dtype, np.integer):
+            if not np.allclose(new_tnum, np.round(new_tnum)):
+                return False
+            new_tnum = np.round(new_tnum).astype(tvar.dtype)
+
+        # Check everything before writing anything, so the file is never left half-written.
+        varnames = [name for name in data.variables if name not in ["time", "station_name"]]
+        for name in varnames:
+            if name not in fid.variables or set(fid[name].dimensions) != set(data[name].dims):
+                return False
+
+        if len(new_times) > 0:
+            tvar[ntime:ntime + len(new_times)] = new_tnum
+
+        if concat_dim == "time":
+            tslice = slice(ntime, ntime + len(new_times))
+            for name in varnames:
+                ncvar = fid[name]
+                if "time" in ncvar.dimensions:
+                    slicer = tuple(tslice if dim == "time" else slice(None) for dim in ncvar.dimensions)
+                    ncvar[slicer] = data[name].transpose(*ncvar.dimensions).values
+        else:
+            # Align new stations with the time axis of the file. Other stations are filled for the new records.
+            data = data.reindex(time=file_times.append(new_times))
+            nstat = len(file_stations)
+            sslice = slice(nstat, nstat + data.sizes["station_name"])
+            tslice = slice(0, data.sizes["time"])
+
+            for idx, stat in enumerate(data.station_name.values):
+                fid["station_name"][nstat + idx] = str(stat)
+
+            for name in varnames:
+                ncvar = fid[name]
+                if "station_name" in ncvar.dimensions:
+                    slicer = tuple(sslice if dim == "station_name" else tslice if dim == "time" else slice(None)
+                                   for dim in ncvar.dimensions)
+                    ncvar[slicer] = data[name].transpose(*ncvar.dimensions).values
+
+    return True
+
+
+def _times_in_file(tvar, times: pd.DatetimeIndex, calendar: str) -> bool:
+    """
+    True, if all times exist in the (sorted) time variable of a file. The times are encoded with date2num and
+    compared with the raw values of the file, so the time axis of the file is not decoded.
+    """
+
+    tnum = np.asarray(date2num(times.to_pydatetime(), tvar.units, calendar), dtype=float)
+    file_tnum = np.asarray(tvar[:], dtype=float)
+
+    pos = np.searchsorted(file_tnum, tnum)
+    found = np.zeros(len(tnum), dtype=bool)
+    for idx in [np.clip(pos - 1, 0, len(file_tnum) - 1), np.clip(pos, 0, len(file_tnum) - 1)]:
+        found |= np.isclose(file_tnum[idx], tnum, rtol=0, atol=1e-6)
+
+    return bool(found.all())
+
+
+def merge_cfconform_files(filenames: list) -> xr.Dataset:
+    """
+    Opens CF-conform files lazily (as dask arrays) and concatenates them along time.
+
+    The files must be sorted in time, which is the case for the filenames from get_list_of_filenames.
+    Duplicate times can only occur where two files overlap (i.e. at the boundary of two split periods). Therefore,
+    only the beginning of each file is compared with the end of the previous file and nothing is reordered.
+
+    Args:
+        filenames: a list of CF-conform files, sorted in time.
+
+    Returns: a lazy dataset.
+
+    """
+
+    all_data = []
+    tend = None
+    for filename in filenames:
+        data = xr.open_dataset(filename, chunks={})
+        if not data.indexes["time"].is_monotonic_increasing:
+            data = data.sortby("time")
+
+        if tend is not None:
+            first = data.indexes["time"].searchsorted(tend, side="right")
+            data = data.isel(time=slice(first, None))
+
+        if data.sizes["time"] == 0:
+            continue
+
+        tend = data.indexes["time"][-1]
+        all_data.append(data)
+
+    data = xr.concat(all_data, dim="time", data_vars="minimal", coords="minimal", compat="override")
+
+    return data
+
+
+def get_rollup_name(name_of_dataset: str, ave_window) -> str:
+    """
+    Name of the dataset that holds the rollups (averages etc.) of name_of_dataset over ave_window minutes.
+    This is the same naming convention as used for model data (Ave10Min etc.). ave_window in [None, 0, "raw"] is
+    the dataset itself.
+    """
+
+    if ave_window in [None, 0, "0", "raw"]:
+        return name_of_dataset
+    return f"{name_of_dataset}_Ave{int(ave_window)}Min"
+
+
+def list_rollups(name_of_dataset: str) -> list:
+    """
+    Returns a sorted list of all averaging windows (in minutes) for which rollups of name_of_dataset exist.
+    """
+
+    filepath = Path(os.environ["OBSERVATIONS_PATH"])
+    windows = []
+    for item in filepath.glob(f"{name_of_dataset}_Ave*Min"):
+        window = item.name.replace(f"{name_of_dataset}_Ave", "")[:-3]
+        if item.is_dir() and window.isdigit():
+            windows.append(int(window))
+
+    return sorted(windows)
+
+
+def select_rollup(name_of_dataset: str, ave_window=None, verbose=False) -> str:
+    """
+    Selects the dataset (raw data or rollup) to read.
+
+    Args:
+        name_of_dataset: the name of the raw dataset
+        ave_window: averaging window in minutes. Raw data is used if None, or if no rollups over ave_window exist.
+            Callers comparing with model data pass the averaging window of the model data.
+        verbose: if True, speak with user
+
+    Returns: the name of the dataset to read.
+
+    """
+
+    name = get_rollup_name(name_of_dataset, ave_window)
+    if name != name_of_dataset and int(ave_window) not in list_rollups(name_of_dataset):
+        if verbose:
+            print(f"No rollups for {ave_window} min found, using raw data of {name_of_dataset}")
+        name = name_of_dataset
+
+    return name
+
+
+def calc_rollup(data: xr.Dataset, ave_window: int, statistics=True) -> xr.Dataset:
+    """
+    Calculates mean, std, min, max and count over ave_window minutes for all variables with a time dimension.
+    For variables starting with DIR, the circular mean and the circular standard deviation are calculated instead
+    (min and max are meaningless for directions).
+
+    The mean keeps the name of the variable, the other statistics are named <variable>_std etc.
+    Intervals are labeled with their start. data must be sorted in time.
+
+    Args:
+        data: a dataset with the dimension time
+        ave_window: the averaging window in minutes
+        statistics: if False, only the means are calculated
+
+    Returns: the rollup dataset
+
+    """
+
+    window_ns = int(ave_window) * 60 * 10 ** 9
+    tint = data["time"].values.astype("datetime64[ns]").astype(np.int64)
+    bins = tint - np.mod(tint, window_ns)
+
+    # Data is sorted, so every interval is a contiguous block and reduceat can be used.
+    starts = np.concatenate([[0], np.where(np.diff(bins) != 0)[0] + 1]) if len(bins) > 0 else np.array([], int)
+    tvec = bins[starts].astype("datetime64[ns]")
+
+    rollup = xr.Dataset(coords={"time": tvec})
+    for name, item in data.variables.items():
+        if name == "time" or "time" in item.dims:
+            continue
+        if name in data.coords:
+            rollup = rollup.assign_coords({name: item})
+        else:
+            rollup = rollup.assign({name: item})
+
+    for name, item in data.data_vars.items():
+        if "time" not in item.dims or not np.issubdtype(item.dtype, np.number):
+            continue
+
+        dims = ["time"] + [dim for dim in item.dims if dim != "time"]
+        values = item.transpose(*dims).values.astype(float)
+        valid = ~np.isnan(values)
+        count = np.add.reduceat(valid, starts, axis=0)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if str(name).startswith("DIR"):
+                rad = np.deg2rad(values)
+                ssum = np.add.reduceat(np.where(valid, np.sin(rad), 0), starts, axis=0) / count
+                csum = np.add.reduceat(np.where(valid, np.cos(rad), 0), starts, axis=0) / count
+                mean = np.mod(np.rad2deg(np.arctan2(ssum, csum)), 360)
+                std = np.rad2deg(np.sqrt(-2 * np.log(np.minimum(np.sqrt(ssum ** 2 + csum ** 2), 1))))
+                stats = {"": mean, "_std": std}
+            else:
+                mean = np.add.reduceat(np.where(valid, values, 0), starts, axis=0) / count
+                sumsq = np.add.reduceat(np.where(valid, values ** 2, 0), starts, axis=0) / count
+                std = np.sqrt(np.maximum(sumsq - mean ** 2, 0))
+                stats = {
+                    "": mean,
+                    "_std": std,
+                    "_min": np.fmin.reduceat(values, starts, axis=0),
+                    "_max": np.fmax.reduceat(values, starts, axis=0),
+                }
+
+        if not statistics:
+            stats = {"": stats[""]}
+
+        for suffix, value in stats.items():
+            attrs = item.attrs.copy()
+            attrs["cell_methods"] = f"time: {suffix[1:] or 'mean'} (interval: {int(ave_window)} minutes)"
+            rollup[f"{name}{suffix}"] = (dims, np.where(count > 0, value, np.nan), attrs)
+
+        if statistics:
+            attrs = {"long_name": f"number of valid records of {name}"}
+            rollup[f"{name}_count"] = (dims, count.astype(np.int32), attrs)
+
+    rollup = rollup.assign_attrs(data.attrs)
+    rollup = rollup.assign_attrs(ave_window=int(ave_window))
+
+    return rollup
+
+
+def calc_availability(data: xr.Dataset, variables=None, freq="D") -> pd.DataFrame:
+    """
+    Calculates the data availability, i.e. the percentage of records that are not NaN, for many variables and
+    stations at once. All years in data are treated at once as well.
+
+    Args:
+        data: a dataset with the dimension time and optionally station_name.
+        variables: a variable or a list of variables. If None, all variables with the dimension time are used.
+        freq: D for daily, MS for monthly, YS for yearly availability.
+
+    Returns: a tidy table with the columns time (start of the period), station_name, variable, valid (number of
+    valid records), total (number of records) and availability (in %).
+
+    """
+
+    units = {"D": "datetime64[D]", "MS": "datetime64[M]", "YS": "datetime64[Y]"}
+    if freq not in units:
+        print(f"freq must be one of {list(units.keys())}")
+        raise ValueError
+
+    if variables is None:
+        variables = [name for name in data.data_vars if "time" in data[name].dims]
+    elif isinstance(variables, str):
+        variables = [variables]
+
+    periods = data["time"].values.astype(units[freq])
+    tvec, inverse = np.unique(periods, return_inverse=True)
+    total = np.bincount(inverse, minlength=len(tvec))
+
+    all_tables = []
+    for var in variables:
+        if "station_name" in data[var].dims:
+            values = data[var].transpose("time", "station_name").values
+            stations = data["station_name"].values.astype(str)
+        else:
+            values = data[var].values[:, np.newaxis]
+            stations = [str(data["station_name"].values) if "station_name" in data.coords else ""]
+
+        # count valid records per period and station with a single bincount.
+        ncol = values.shape[1]
+        index = inverse[:, np.newaxis] * ncol + np.arange(0, ncol)
+        valid = np.bincount(index.ravel(), weights=~np.isnan(values).ravel(), minlength=len(tvec) * ncol)
+
+        table = pd.DataFrame(
+            {
+                "time": np.repeat(tvec.astype("datetime64[ns]"), ncol),
+                "station_name": np.tile(stations, len(tvec)),
+                "variable": var,
+                "valid": valid.astype(int),
+                "total": np.repeat(total, ncol),
+            }
+        )
+        all_tables.append(table)
+
+    if len(all_tables) == 0:
+        return pd.DataFrame(columns=["time", "station_name", "variable", "valid", "total", "availability"])
+
+    table = pd.concat(all_tables, ignore_index=True)
+    table["availability"] = table["valid"] / table["total"] * 100.0
+
+    return table
+
+
 def calc_PT(data):
     """
     Calculate PT from P and T if these variables exists.
@@ -401,26 +953,27 @@ def calc_PT(data):
     This may not be general enough!
     """
 
+    index = get_variable_index(data)
+
     def calc_PT_single_station(sdata):
 
-        tmp_p = [i for i in list(sdata.variables) if i.startswith("P_")]
-        tmp_t = [i for i in list(sdata.variables) if i.startswith("T_")]
         hgt = sdata["station_elevation"].values
 
-        zp = [int(item.split("_")[1]) for item in tmp_p]
-        zlow, zhigh = min(zp), max(zp)
+        zp = index.heights("P")
+        zlow, zhigh = zp[0], zp[-1]
 
-        if sdata["P_" + str(zlow)].units == "hPa":
+        if index.units[index.name("P", "", zlow)] == "hPa":
             factor = 100
-        elif sdata["P_" + str(zlow)].units == "Pa":
+        elif index.units[index.name("P", "", zlow)] == "Pa":
             factor = 1
         else:
             raise ValueError
 
-        plow = sdata["P_" + str(zlow)].values.T * factor
-        phigh = sdata["P_" + str(zhigh)].values.T * factor
+        plow = sdata[index.name("P", "", zlow)].values.T * factor
+        phigh = sdata[index.name("P", "", zhigh)].values.T * factor
 
-        ztarget = np.asarray([int(item.split("_")[1]) for item in tmp_t])
+        ztarget = index.heights("T")
+        names = [index.name("T", "", item) for item in ztarget]
 
         # z amsl
         zlow = float(zlow) + hgt
@@ -436,25 +989,22 @@ def calc_PT(data):
         H = (zhigh - zlow) / np.log(plow / phigh)
         p0 = phigh / np.exp(-zhigh / H)
 
-        for zlev in ztarget:
+        for zlev, name in zip(ztarget, names):
             ptarget = p0 * np.exp(-zlev / H)
             ##############################################
             kappa = 2.0 / 7.0  # R/cp
             p00 = 10 ** 5  # Pa
             ##############################################
 
-            pt = (sdata["T_" + str(int(zlev))][:] + 273.15) * (p00 / ptarget) ** kappa
+            pt = (sdata[name][:] + 273.15) * (p00 / ptarget) ** kappa
             pt = pt.assign_attrs(units="K")
             pt = pt.assign_attrs(standard_name="potential_temperature")
             pt = pt.assign_attrs(long_name="potential temperature")
-            sdata = sdata.assign({"PT_" + str(int(zlev)): pt})
+            sdata = sdata.assign({"P" + name: pt})
         ####################################################################################
         return sdata
 
-    tmp1 = [i for i in list(data.variables) if i.startswith("P_")]
-    tmp2 = [i for i in list(data.variables) if i.startswith("T_")]
-
-    if len(tmp1) <= 1 or len(tmp2) == 0:
+    if len(index.heights("P")) <= 1 or len(index.heights("T")) == 0:
         return data
 
     if "station_name" in data.dims:
@@ -514,7 +1064,9 @@ class Timeseries:
         1) Provide "data". Must be an xr.Dataset or xr.DataArray.
         2) Read data conform with this class. -> read_cfconform_data
         3) Read non-conform nc-data. -> read_non_conform_ncdata
-        4) to be extended.
+        4) Convert non-conform nc-data or csv-data to CF-conform files. -> ingest_non_conform_ncdata,
+           read_non_conform_csvdata
+        5) to be extended.
 
         Args:
             name_of_dataset: The name of the Dataset. Used to create a folderstructure and search for data.
@@ -549,6 +1101,8 @@ class Timeseries:
             verbose=False,
             use_dask=False,
             split=None,
+            use_cache=False,
+            ave_window=None,
     ):
         """
         Read timeseries data that is already conform with this class, i.e. get_list_of_filenames can find the data
@@ -560,8 +1114,12 @@ class Timeseries:
             metadata: additional metadata or changes to the metadata that should be made.
             calc_pt: if potential temperature should be caluclated from temperature and pressure.
             verbose: Speak with user.
-            use_dask: open as dask array
+            use_dask: open as dask array. If False, data is loaded into memory.
             split: YS for yearly, MS for monthly or None for no splitting
+            use_cache: read from the columnar cache of the dataset (see obs_cache), which is much faster for repeated
+                reads. The cache is built or updated if necessary. Data is read-only in this case.
+            ave_window: read the rollups over ave_window minutes instead of the raw data (see build_rollups).
+                Raw data is read if None (default) or if no matching rollups exist.
 
         Returns: None
 
@@ -570,7 +1128,19 @@ class Timeseries:
         if metadata is None:
             metadata = dict()
 
-        filenames, disc = get_list_of_filenames(self.dataset, dtstart, dtend, split)
+        dataset = select_rollup(self.dataset, ave_window, verbose=verbose)
+
+        if use_cache:
+            data = read_obs_cache(dataset, dtstart, dtend, verbose=verbose)
+            if calc_pt:
+                try:
+                    data = calc_PT(data)
+                except:
+                    pass
+            self.data = data.assign_attrs(metadata)
+            return
+
+        filenames, disc = get_list_of_filenames(dataset, dtstart, dtend, split)
         if len(filenames) == 0:
             if verbose:
                 print("No filenames found")
@@ -580,17 +1150,9 @@ class Timeseries:
             for filename in filenames:
                 print(f"Loading File {filename}")
 
-        if use_dask:
-            data = xr.open_mfdataset(filenames)
-        else:
-            data = []
-            for filename in filenames:
-                tmp = xr.load_dataset(filename)
-                data.append(tmp)
-            data = xr.concat(data, dim="time")
-            # drop duplicates
-            _, index = np.unique(data['time'], return_index=True)
-            data = data.isel(time=index)
+        data = merge_cfconform_files(filenames)
+        if not use_dask:
+            data = data.load()
 
         if calc_pt:
             # This will only do something if T_X and P_Y exists.
@@ -642,6 +1204,8 @@ class Timeseries:
         if translator is None:
             translator = dict()
 
+        cf_table = read_cf_table()
+
         all_data = []
         for idx, filename in enumerate(filenames):
             data = xr.open_dataset(filename)
@@ -653,11 +1217,6 @@ class Timeseries:
             metadata["lon"] = meta_table.iloc[idx].lon
             metadata["station_elevation"] = meta_table.iloc[idx].elev
 
-            cf_table = (
-                    os.path.split(os.path.realpath(__file__))[0]
-                    + "/resources/cf_table_timeseries_fields.yaml"
-            )
-
             data = assign_cf_attributes_tslist(data, metadata, cf_table, old_attrs, verbose)
             all_data.append(data)
             data.close()
@@ -668,8 +1227,174 @@ class Timeseries:
         self.data = self.data.set_index({concat_dim: concat_dim})
         self.data[concat_dim].attrs = save_attts
 
-    def read_non_conform_csvdata(self):
-        raise NotImplementedError
+    def ingest_non_conform_ncdata(
+            self,
+            filenames: list,
+            meta_table: pd.DataFrame,
+            translator=None,
+            metadata=None,
+            old_attrs=None,
+            split="YS",
+            batch_size=50,
+            max_workers=None,
+            cf_table=None,
+            verbose=False,
+    ):
+        """
+        Bulk version of read_non_conform_ncdata for a large number of files (i.e. thousands of daily files).
+
+        The files are converted by a pool of workers and written to CF-conform files (see write_cfconform_data)
+        in batches of batch_size files, sorted by time. This way, each batch is appended to the existing files and
+        only batch_size files are kept in memory at once. self.data is not changed.
+
+        Args:
+            filenames: a list of paths to the files to be read.
+            meta_table: see read_non_conform_ncdata. Either a single line (all files belong to the same station) or
+                one line per file.
+            translator: a dict that translated variable names in the dataset to variable names used with this class.
+            metadata: a dict of attributes that will be used as metadata.
+            old_attrs: a list of attributes that may exist in the ncdata and should be removed.
+            split: YS for yearly, MS for monthly files
+            batch_size: number of files that are converted and written at once
+            max_workers: number of worker processes. Defaults to the number of cpus.
+            cf_table: path to the table of CF attributes. If None, the default table is used (see read_cf_table).
+            verbose: if True, speak with user
+
+        Returns: None
+
+        """
+
+        if isinstance(filenames, list) is False:
+            filenames = [filenames]
+        if metadata is None:
+            metadata = dict()
+            metadata["featureType"] = "timeSeries"  # assuming the feature
+        if old_attrs is None:
+            old_attrs = []
+        if translator is None:
+            translator = dict()
+
+        all_metadata = _get_metadata_per_file(meta_table, metadata, len(filenames))
+
+        # Parse the table only once for all files.
+        cf_table = read_cf_table(cf_table)
+
+        timename = {value: key for key, value in translator.items()}.get("time", "time")
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+
+            timeranges = list(executor.map(_get_timerange, filenames, [timename] * len(filenames)))
+            order = sorted(range(0, len(filenames)), key=lambda ii: timeranges[ii])
+
+            start = 0
+            while start < len(order):
+                end = min(start + batch_size, len(order))
+                # Files that start at the same time belong to the same batch.
+                while end < len(order) and timeranges[order[end]][0] == timeranges[order[end - 1]][0]:
+                    end += 1
+                batch_idx = order[start:end]
+
+                if verbose:
+                    print(f"Converting files {start + 1} to {end} of {len(order)}")
+
+                batch = list(
+                    executor.map(
+                        _convert_non_conform_file,
+                        [filenames[ii] for ii in batch_idx],
+                        [translator] * len(batch_idx),
+                        [all_metadata[ii] for ii in batch_idx],
+                        [cf_table] * len(batch_idx),
+                        [old_attrs] * len(batch_idx),
+                        [verbose] * len(batch_idx),
+                    )
+                )
+
+                ts = Timeseries(self.dataset, _combine_batch(batch))
+                ts.write_cfconform_data(overwrite=False, concat_dim="time", split=split, verbose=verbose)
+
+                start = end
+
+    def read_non_conform_csvdata(
+            self,
+            filenames: Union[str, list, PosixPath, os.PathLike],
+            meta_table: pd.DataFrame,
+            translator=None,
+            metadata=None,
+            old_attrs=None,
+            time_column="time",
+            time_format=None,
+            dtypes=None,
+            chunksize=100000,
+            split="YS",
+            cf_table=None,
+            verbose=False,
+            **kwargs,
+    ):
+        """
+        Reads csv data (i.e. logger exports) that is not conform with this class and writes it to CF-conform files.
+
+        The files are parsed in chunks of chunksize lines. Each chunk is converted (see read_non_conform_ncdata)
+        and written with write_cfconform_data directly, so files never have to fit in memory. For this reason,
+        self.data is not changed.
+
+        Args:
+            filenames: a path or a list of paths to the filenames to be read.
+            meta_table: see read_non_conform_ncdata. Either a single line (all files belong to the same station) or
+                one line per file.
+            translator: a dict that translated column names in the csv file to variable names used with this class.
+            metadata: a dict of attributes that will be used as metadata.
+            old_attrs: a list of attributes that should be removed.
+            time_column: the name of the column with the timestamps.
+            time_format: the format of the timestamps, i.e. "%Y-%m-%d %H:%M:%S". If None, pandas infers the format,
+                which is much slower for large files.
+            dtypes: a dict of dtypes per column. By default, all columns but time_column are read as float64, so that
+                all chunks of a file have the same dtype.
+            chunksize: number of lines that are read and written at once.
+            split: YS for yearly, MS for monthly files
+            cf_table: path to the table of CF attributes. If None, the default table is used (see read_cf_table).
+            verbose: if True, speak with user
+            **kwargs: passed to pd.read_csv, i.e. sep, skiprows, na_values.
+
+        Returns: None
+
+        """
+
+        if isinstance(filenames, list) is False:
+            filenames = [filenames]
+        if metadata is None:
+            metadata = dict()
+            metadata["featureType"] = "timeSeries"  # assuming the feature
+        if old_attrs is None:
+            old_attrs = []
+        if translator is None:
+            translator = dict()
+        if dtypes is None:
+            dtypes = dict()
+
+        all_metadata = _get_metadata_per_file(meta_table, metadata, len(filenames))
+        cf_table = read_cf_table(cf_table)
+
+        for idx, filename in enumerate(filenames):
+
+            columns = pd.read_csv(filename, nrows=0, **kwargs).columns
+            file_dtypes = {col: "float64" for col in columns if col != time_column}
+            file_dtypes.update(dtypes)
+
+            reader = pd.read_csv(filename, dtype=file_dtypes, chunksize=chunksize, **kwargs)
+            for num, chunk in enumerate(reader):
+
+                if verbose:
+                    print(f"Converting lines {num * chunksize + 1} to {num * chunksize + len(chunk)} of {filename}")
+
+                tvec = pd.to_datetime(chunk.pop(time_column), format=time_format)
+                chunk.index = pd.DatetimeIndex(tvec, name="time")
+                chunk = chunk.rename(columns=translator)
+
+                data = xr.Dataset.from_dataframe(chunk)
+                data = assign_cf_attributes_tslist(data, all_metadata[idx], cf_table, old_attrs, verbose)
+
+                ts = Timeseries(self.dataset, _combine_batch([data]))
+                ts.write_cfconform_data(overwrite=False, concat_dim="time", split=split, verbose=verbose)
 
     def apply_cf_attributes(self, station_name: str, lat: float, lon: float, elev: float, verbose=False):
         # Will need this method later anyway.
@@ -697,7 +1422,7 @@ class Timeseries:
     # ----------------------------------------------------------------------
     def write_cfconform_data(self, overwrite=False, concat_dim="station_name", split=None, verbose=False):
         """
-        Write data to
+        Write data to CF-conform files, see get_list_of_filenames.
         Args:
             overwrite: if True, an existing file will be overwritten. If False, and the file exists,
             data will be appended along the dimension concat_dim.
@@ -705,43 +1430,122 @@ class Timeseries:
             split: YS for yearly, MS for monthly or None for no splitting
             verbose: if True, speak with user
 
+        If possible, data is appended in place (see append_to_cfconform_file), so existing files are not rewritten.
+        This is the case for new time records after the end of the file and for new stations. Otherwise, the file
+        is read, merged with the new data and rewritten.
+
         Returns: None
 
         """
 
         # Create class conform filename.
-        t1 = self.data.time[0].values
-        t2 = self.data.time[-1].values
-        dtstart = dt.datetime.fromtimestamp(t1.item() / 10 ** 9)
-        dtend = dt.datetime.fromtimestamp(t2.item() / 10 ** 9)
+        dtstart = pd.Timestamp(self.data.time[0].values).to_pydatetime()
+        dtend = pd.Timestamp(self.data.time[-1].values).to_pydatetime()
 
         filenames, tvec_split = get_list_of_filenames(self.dataset, dtstart, dtend, split)
 
+        times = self.data.indexes["time"]
         for idx in range(0, len(filenames)):
             targetfile = filenames[idx]
-            subset = self.data.sel(time=slice(tvec_split[idx], tvec_split[idx + 1]))
+
+            # Periods are half-open [start, end), so a record at the boundary is written to a single file. Only the
+            # last period includes its end.
+            tstart, tend = pd.Timestamp(tvec_split[idx]), pd.Timestamp(tvec_split[idx + 1])
+            in_period = (times >= tstart) & (times < tend)
+            if idx == len(filenames) - 1:
+                in_period |= times == tend
+            subset = self.data.isel(time=np.where(in_period)[0])
 
             if os.path.exists(targetfile) and not overwrite:
                 if verbose:
                     print(f"merging into {targetfile}")
-                old_data = xr.open_dataset(targetfile)
-                all_data = xr.concat([old_data, subset], dim=concat_dim)
-                old_data.close()
 
-                if concat_dim not in all_data.indexes:
-                    all_data = all_data.set_index({concat_dim: concat_dim})
+                if append_to_cfconform_file(targetfile, subset, concat_dim, verbose):
+                    continue
+
+                if verbose:
+                    print(f"Cannot append in place, rewriting {targetfile}")
+
+                old_data = xr.load_dataset(targetfile)
+                if concat_dim == "time":
+                    # keep the data that was already in the file, fill gaps with new data.
+                    all_data = old_data.combine_first(subset)
+                else:
+                    all_data = xr.concat([old_data, subset], dim=concat_dim)
+
+                    if concat_dim not in all_data.indexes:
+                        all_data = all_data.set_index({concat_dim: concat_dim})
 
+                    # drop duplicates, keep the data that was already in the file.
+                    _, index = np.unique(all_data["time"], return_index=True)
+                    all_data = all_data.isel(time=index)
                 old_data.close()
 
-                all_data.to_netcdf(targetfile, mode="w", unlimited_dims="time")
+                encoding, unlimited_dims = get_cfconform_encoding(all_data)
+                all_data.to_netcdf(targetfile, mode="w", unlimited_dims=unlimited_dims, encoding=encoding)
                 all_data.close()
-            elif os.path.exists(targetfile) and overwrite:
+            else:
                 if verbose:
                     print(f"Write new file {targetfile}")
-                subset.to_netcdf(targetfile, mode="w", unlimited_dims="time")
-            elif not os.path.exists(targetfile):
                 targetfile.parent.mkdir(exist_ok=True)
-                subset.to_netcdf(targetfile, mode="w", unlimited_dims="time")
+                encoding, unlimited_dims = get_cfconform_encoding(subset)
+                subset.to_netcdf(targetfile, mode="w", unlimited_dims=unlimited_dims, encoding=encoding)
+
+    def build_rollups(self, windows=(10, 60, 1440), split="YS", chunk_days=31, verbose=False):
+        """
+        Builds rollups (mean, std, min, max, count, see calc_rollup) of all CF-conform files of this dataset for
+        multiple averaging windows. Each rollup is stored as its own CF-conform dataset next to the raw data,
+        i.e. <name_of_dataset>_Ave10Min, so that read_cfconform_data can select it with ave_window.
+
+        The raw data is read once, in chunks of chunk_days days. All windows are calculated from each chunk and
+        appended to the rollup files, so the raw data never has to fit in memory. Existing rollups are replaced.
+
+        Args:
+            windows: averaging windows in minutes. Each window must divide a day.
+            split: YS for yearly, MS for monthly rollup files
+            chunk_days: number of days of raw data that are processed at once
+            verbose: if True, speak with user
+
+        Returns: None
+
+        """
+
+        if any(1440 % int(window) != 0 for window in windows):
+            print("Each averaging window must divide a day (1440 minutes)")
+            raise ValueError
+
+        filepath = Path(os.environ["OBSERVATIONS_PATH"])
+        filenames = sorted((filepath / self.dataset).glob(f"{self.dataset}*.nc"))
+        if len(filenames) == 0:
+            if verbose:
+                print(f"No files found for dataset {self.dataset}")
+            return
+
+        for window in windows:
+            rollup_path = filepath / get_rollup_name(self.dataset, window)
+            if rollup_path.is_dir():
+                shutil.rmtree(rollup_path)
+
+        data = merge_cfconform_files(filenames)
+        tvec = data.indexes["time"]
+
+        # Chunks start at midnight, so no averaging interval is split between two chunks.
+        chunk_starts = pd.date_range(tvec[0].floor("D"), tvec[-1], freq=f"{chunk_days}D")
+        for idx, chunk_start in enumerate(chunk_starts):
+            first = tvec.searchsorted(chunk_start, side="left")
+            last = tvec.searchsorted(chunk_start + pd.Timedelta(days=chunk_days), side="left")
+            if first == last:
+                continue
+
+            if verbose:
+                print(f"Building rollups of {self.dataset}, chunk {idx + 1} of {len(chunk_starts)}")
+
+            chunk = data.isel(time=slice(first, last)).load()
+            for window in windows:
+                rollup = Timeseries(get_rollup_name(self.dataset, window), calc_rollup(chunk, window))
+                rollup.write_cfconform_data(overwrite=False, concat_dim="time", split=split, verbose=verbose)
+
+        data.close()
 
     # ----------------------------------------------------------------------
     #  Plotters
@@ -765,31 +1569,12 @@ class Timeseries:
 
         """
 
-        # first, get timeseries of the chosen variable and dtvec
         if "station_name" in self.data.indexes:
-            data = self.data.sel({"station_name": station_name})[var].values
+            data = self.data[[var]].sel({"station_name": [station_name]})
         else:
-            data = self.data[var].values
-
-        dtvec = self.data.time.values
-
-        dtvec_dt = []
-        for dt64 in dtvec:
-            ts = (dt64 - np.datetime64("1970-01-01T00:00:00")) / np.timedelta64(1, "s")
-            dtvec_dt.append(dt.datetime.utcfromtimestamp(ts))
-
-        # now, calculate the Availability Matrix for each day of the year [0-100 %]
-        Avail = np.zeros([12, 31]) * np.nan
-        for mon in np.arange(1, 13):
-            for day in np.arange(1, 32):
-                mask = [item.day == day and item.month == mon for item in dtvec_dt]
-                tmp_data = data[mask]
-
-                tmp_dtvec = np.asarray(dtvec_dt)
-                tmp_dtvec = tmp_dtvec[mask]
-                if len(tmp_dtvec) > 0:
-                    Avail[mon - 1, day - 1] = (
-                                                      1 - sum(np.isnan(tmp_data)) / len(tmp_data)
-                                              ) * 100.0
-
-        Availability(Avail, zz, var, year, savename)
+            data = self.data[[var]]
+
+        avail = calc_availability(data, var, freq="D")
+        avail = avail[avail["time"].dt.year == int(year)]
+
+        Availability(avail, zz, var, year, savename)
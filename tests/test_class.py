@@ -2,13 +2,17 @@ import matplotlib.pyplot as plt
 import os
 import shutil
 import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import pytest
 import pandas as pd
 import xarray as xr
 
+import numpy as np
 from wrfplotter.wrfplotter_classes import Map, Timeseries, calc_PT, get_list_of_filenames
-
+from wrfplotter.wrfplotter_classes import append_to_cfconform_file, get_cfconform_encoding, calc_availability
+from wrfplotter.wrfplotter_classes import calc_rollup, list_rollups
+from wrfplotter.obs_cache import read_obs_cache, is_cache_valid, build_obs_cache, get_cache_path
 
 
 # ------------------------------------------------------------------------------------------
@@ -129,7 +133,6 @@ def test_plot(map_env):
             cls.plot(map_t="hvplot", store=True)
 
 
-
 # ------------------------------------------------------------------------------------------
 # Class Timeseries
 # ------------------------------------------------------------------------------------------
@@ -179,6 +182,102 @@ def test_read_cfconform_data(ts_env):
     cls2.read_cfconform_data(dtstart, dtend, None, True, verbose=True, use_dask=False)
 
 
+def test_read_cfconform_data_split(tmp_path, monkeypatch):
+    monkeypatch.setenv("OBSERVATIONS_PATH", str(tmp_path))
+
+    data = _dummy_stations(pd.date_range("2020-01-01", "2020-03-15", freq="h"), ["A", "B"])
+    Timeseries("Splitset", data=data).write_cfconform_data(split="MS")
+
+    dtstart = dt.datetime(2020, 1, 1)
+    dtend = dt.datetime(2020, 3, 15)
+
+    # the boundaries of the monthly files are stored twice but read once.
+    cls = Timeseries("Splitset")
+    cls.read_cfconform_data(dtstart, dtend, split="MS", use_dask=True)
+    assert cls.data.WSP_100.chunks is not None
+    assert cls.data.indexes["time"].equals(data.indexes["time"])
+
+    cls.read_cfconform_data(dtstart, dtend, split="MS", use_dask=False)
+    assert cls.data.WSP_100.chunks is None
+    assert (cls.data.WSP_100 == data.WSP_100).all()
+
+
+def test_read_obs_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("OBSERVATIONS_PATH", str(tmp_path))
+
+    data = _dummy_stations(pd.date_range("2020-01-01", "2020-03-15", freq="h"), ["A", "B"])
+    Timeseries("Cacheset", data=data).write_cfconform_data(split="MS")
+
+    dtstart = dt.datetime(2020, 1, 10)
+    dtend = dt.datetime(2020, 2, 15)
+
+    cls = Timeseries("Cacheset")
+    cls.read_cfconform_data(dtstart, dtend, use_cache=True, verbose=True)
+    assert is_cache_valid("Cacheset")
+    assert (cls.data.WSP_100 == data.WSP_100.sel(time=slice(dtstart, dtend))).all()
+    assert list(cls.data.lat.values) == [0, 1]
+
+    # cache is rebuilt if the files change.
+    new_data = _dummy_stations(pd.date_range("2020-03-16", periods=3, freq="h"), ["A", "B"])
+    Timeseries("Cacheset", data=new_data).write_cfconform_data(concat_dim="time", split="MS")
+    assert not is_cache_valid("Cacheset")
+
+    cached = read_obs_cache("Cacheset", dt.datetime(2020, 3, 15), dt.datetime(2020, 3, 17))
+    assert cached.sizes["time"] == 4
+    assert is_cache_valid("Cacheset")
+
+    # concurrent builds: the link always points to a complete cache and old versions are removed.
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(lambda item: build_obs_cache("Cacheset"), range(4)))
+
+    assert get_cache_path("Cacheset").is_symlink()
+    assert is_cache_valid("Cacheset")
+    assert len(list(tmp_path.glob("Cacheset/.cache_v*"))) == 1
+    assert len(list(tmp_path.glob("Cacheset/.cache_tmp*"))) == 0
+    recached = read_obs_cache("Cacheset", dt.datetime(2020, 3, 15), dt.datetime(2020, 3, 17))
+    assert (cached.WSP_100 == recached.WSP_100).all()
+
+
+def test_calc_rollup():
+    data = _dummy_stations(pd.date_range("2020-01-01", periods=120, freq="min"), ["A", "B"])
+    data["WSP_100"][0:10, 0] = np.nan
+    data["DIR_100"] = data["WSP_100"] * 0 + np.tile([350.0, 20.0], (120, 1))
+
+    rollup = calc_rollup(data, 60)
+
+    expected = data.WSP_100.resample(time="60min").mean()
+    assert np.allclose(rollup.WSP_100.values, expected.values)
+    assert np.allclose(rollup.WSP_100_max.values, data.WSP_100.resample(time="60min").max().values)
+    assert list(rollup.WSP_100_count.values[:, 0]) == [50, 60]
+    assert np.allclose(rollup.DIR_100.values[0], [350.0, 20.0])
+    assert "DIR_100_min" not in rollup
+
+
+def test_build_rollups(tmp_path, monkeypatch):
+    monkeypatch.setenv("OBSERVATIONS_PATH", str(tmp_path))
+
+    data = _dummy_stations(pd.date_range("2020-01-01", "2020-03-01", freq="min", inclusive="left"), ["A", "B"])
+    Timeseries("Rollupset", data=data).write_cfconform_data(split="MS")
+
+    cls = Timeseries("Rollupset")
+    cls.build_rollups(windows=(10, 60), split="MS", chunk_days=10, verbose=True)
+    assert list_rollups("Rollupset") == [10, 60]
+
+    dtstart = dt.datetime(2020, 1, 1)
+    dtend = dt.datetime(2020, 3, 1)
+    cls.read_cfconform_data(dtstart, dtend, split="MS", ave_window=60)
+    assert cls.data.sizes["time"] == 60 * 24
+    assert np.allclose(cls.data.WSP_100.values, data.WSP_100.resample(time="60min").mean().values)
+
+    # the raw data is read by default, even if rollups exist.
+    cls.read_cfconform_data(dtstart, dt.datetime(2020, 1, 2), split="MS")
+    assert "ave_window" not in cls.data.attrs
+    assert cls.data.indexes["time"][1] - cls.data.indexes["time"][0] == pd.Timedelta(minutes=1)
+
+    with pytest.raises(ValueError):
+        cls.build_rollups(windows=(7,))
+
+
 @pytest.mark.wip
 def test_read_non_conform_ncdata(ts_env):
     filenames = ts_env
@@ -208,11 +307,67 @@ def test_read_non_conform_ncdata(ts_env):
     )
 
 
-@pytest.mark.wip
-def test_read_non_conform_csvdata():
-    cls = Timeseries("Testset")
-    with pytest.raises(NotImplementedError):
-        cls.read_non_conform_csvdata()
+def test_ingest_non_conform_ncdata(tmp_path, monkeypatch):
+    monkeypatch.setenv("OBSERVATIONS_PATH", str(tmp_path))
+
+    cf_table = tmp_path / "cf_table.yaml"
+    cf_table.write_text("WSP:\n  units: m s-1\n  standard_name: wind_speed\n")
+
+    filenames = []
+    for stat in ["FINO1", "FINO2"]:
+        for day in pd.date_range("2020-01-30", periods=4, freq="D"):
+            tvec = pd.date_range(day, periods=144, freq="10min")
+            data = xr.Dataset({"ws": (("Time",), np.full(144, float(day.day)))}, coords={"Time": tvec})
+            filename = tmp_path / f"raw_{stat}_{day.strftime('%Y%m%d')}.nc"
+            data.to_netcdf(filename)
+            filenames.append(filename)
+
+    meta_table = pd.DataFrame(
+        {"lat": 8 * [54.0], "lon": 8 * [6.5], "elev": 8 * [0.0]}, index=4 * ["FINO1"] + 4 * ["FINO2"]
+    )
+    translator = {"ws": "WSP_100", "Time": "time"}
+
+    cls = Timeseries("Bulkset")
+    cls.ingest_non_conform_ncdata(
+        filenames, meta_table, translator, split="MS", batch_size=3, max_workers=2, cf_table=cf_table, verbose=True
+    )
+
+    january = xr.load_dataset(tmp_path / "Bulkset/Bulkset_20200101_20200201.nc")
+    february = xr.load_dataset(tmp_path / "Bulkset/Bulkset_20200201_20200301.nc")
+
+    assert list(january.station_name.values) == ["FINO1", "FINO2"]
+    assert january.sizes["time"] == 2 * 144
+    assert february.sizes["time"] == 2 * 144
+    assert february.WSP_100.units == "m s-1"
+    assert not february.WSP_100.isnull().any()
+
+
+def test_read_non_conform_csvdata(tmp_path, monkeypatch):
+    monkeypatch.setenv("OBSERVATIONS_PATH", str(tmp_path))
+
+    cf_table = tmp_path / "cf_table.yaml"
+    cf_table.write_text("WSP:\n  units: m s-1\n")
+
+    tvec = pd.date_range("2020-01-31 12:00", periods=300, freq="10min")
+    csvdata = pd.DataFrame({"Timestamp": tvec.strftime("%d.%m.%Y %H:%M"), "ws": np.arange(300), "status": 300 * [1]})
+    filename = tmp_path / "logger_export.csv"
+    csvdata.to_csv(filename, sep=";", index=False)
+
+    meta_table = pd.DataFrame({"lat": [54.0], "lon": [6.5], "elev": [0.0]}, index=["FINO1"])
+
+    cls = Timeseries("CSVset")
+    cls.read_non_conform_csvdata(
+        filename, meta_table, translator={"ws": "WSP_100"}, time_column="Timestamp", time_format="%d.%m.%Y %H:%M",
+        dtypes={"status": "int32"}, chunksize=64, split="MS", cf_table=cf_table, verbose=True, sep=";",
+    )
+
+    january = xr.load_dataset(tmp_path / "CSVset/CSVset_20200101_20200201.nc")
+    february = xr.load_dataset(tmp_path / "CSVset/CSVset_20200201_20200301.nc")
+
+    assert january.WSP_100.units == "m s-1"
+    assert january.sizes["time"] + february.sizes["time"] == 300  # midnight is written to February only.
+    assert february.indexes["time"][0] == pd.Timestamp("2020-02-01")
+    assert february.WSP_100.isel(time=-1).values == 299
 
 
 @pytest.mark.wip
@@ -242,6 +397,100 @@ def test_write_cfconform_data(ts_env):
         shutil.rmtree(targetfile.parent)
 
 
+def _dummy_stations(tvec, stations, offset=0.0):
+    tvec = pd.DatetimeIndex(tvec)
+    values = offset + np.arange(len(tvec) * len(stations), dtype=float).reshape(len(tvec), len(stations))
+    return xr.Dataset(
+        {"WSP_100": (("time", "station_name"), values),
+         "lat": (("station_name",), np.arange(len(stations), dtype=float))},
+        coords={"time": tvec, "station_name": stations},
+    )
+
+
+def test_append_to_cfconform_file(tmp_path):
+    targetfile = tmp_path / "Appendset_20200101_20200201.nc"
+
+    data = _dummy_stations(pd.date_range("2020-01-01", periods=5, freq="D"), ["A", "B"])
+    encoding, unlimited_dims = get_cfconform_encoding(data)
+    data.to_netcdf(targetfile, unlimited_dims=unlimited_dims, encoding=encoding)
+
+    # new records, two of them already exist, stations in a different order.
+    new_data = _dummy_stations(pd.date_range("2020-01-04", periods=4, freq="D"), ["B", "A"], offset=100)
+    assert append_to_cfconform_file(targetfile, new_data, "time", verbose=True)
+
+    result = xr.load_dataset(targetfile)
+    assert result.sizes["time"] == 7
+    assert result.WSP_100.sel(station_name="A").values[3] == 6  # kept the old value
+    assert result.WSP_100.sel(station_name="A").values[-1] == 107
+
+    # new station, which extends the time axis of the file.
+    new_data = _dummy_stations(pd.date_range("2020-01-02", periods=9, freq="D"), ["C"], offset=1000)
+    assert append_to_cfconform_file(targetfile, new_data, "station_name", verbose=True)
+
+    result = xr.load_dataset(targetfile)
+    assert list(result.station_name.values) == ["A", "B", "C"]
+    assert result.sizes["time"] == 10
+    assert np.isnan(result.WSP_100.sel(station_name="C").values[0])
+    assert np.isnan(result.WSP_100.sel(station_name="A").values[-1])
+
+    # records within the time range of the file cannot be appended.
+    new_data = _dummy_stations(["2020-01-02 12:00"], ["A", "B", "C"])
+    assert not append_to_cfconform_file(targetfile, new_data, "time")
+
+    # batched ingestion: unsorted batches, each overlapping the previous one by a record.
+    for start in ["2020-01-11", "2020-01-13", "2020-01-15"]:
+        new_data = _dummy_stations(pd.date_range(start, periods=3, freq="D")[::-1], ["A", "B", "C"])
+        assert append_to_cfconform_file(targetfile, new_data, "time")
+
+    result = xr.load_dataset(targetfile)
+    assert result.sizes["time"] == 17
+    assert result.indexes["time"].is_monotonic_increasing
+
+    # new records of existing stations are not skipped when appending stations.
+    new_data = _dummy_stations(pd.date_range("2020-01-18", periods=2, freq="D"), ["A"], offset=500)
+    assert append_to_cfconform_file(targetfile, new_data, "station_name")
+    new_data = _dummy_stations(pd.date_range("2020-01-20", periods=2, freq="D"), ["A", "D"])
+    assert not append_to_cfconform_file(targetfile, new_data, "station_name")
+
+    result = xr.load_dataset(targetfile)
+    assert result.sizes["time"] == 19
+    assert result.WSP_100.sel(station_name="A").values[-1] == 501
+
+
+def test_write_cfconform_data_new_times(tmp_path, monkeypatch):
+    monkeypatch.setenv("OBSERVATIONS_PATH", str(tmp_path))
+
+    data = _dummy_stations(pd.date_range("2020-01-01", periods=24, freq="h"), ["A"])
+    Timeseries("Growset", data=data).write_cfconform_data(split="YS")
+
+    # new times of an existing station, appended with the default concat_dim (station_name).
+    new_data = _dummy_stations(pd.date_range("2020-01-02", periods=24, freq="h"), ["A"], offset=100)
+    Timeseries("Growset", data=new_data).write_cfconform_data(split="YS")
+
+    cls = Timeseries("Growset")
+    cls.read_cfconform_data(dt.datetime(2020, 1, 1), dt.datetime(2020, 12, 31), split="YS", use_dask=False)
+    assert cls.data.sizes["time"] == 48
+    assert cls.data.WSP_100.values[-1] == 123
+
+
+def test_calc_availability(tmp_path):
+    data = _dummy_stations(pd.date_range("2019-12-31", "2020-01-03", freq="6h", inclusive="left"), ["A", "B"])
+    data["WSP_100"][1, 0] = np.nan
+    data["WSP_100"][4:8, 1] = np.nan
+
+    daily = calc_availability(data, "WSP_100", freq="D")
+    assert len(daily) == 3 * 2
+    assert daily.set_index(["time", "station_name"]).loc[("2019-12-31", "A"), "availability"] == 75.0
+    assert daily.set_index(["time", "station_name"]).loc[("2020-01-01", "B"), "availability"] == 0.0
+
+    monthly = calc_availability(data, freq="MS")
+    assert list(monthly["total"]) == [4, 4, 8, 8]
+
+    cls = Timeseries("Testset", data=data)
+    cls.plot_Availability("WSP_100", "B", "2020", 100, str(tmp_path / "TestAvail"))
+    assert (tmp_path / "TestAvail.svg").is_file()
+
+
 @pytest.mark.wip
 def test_plot_Availability(ts_env):
     cls1 = Timeseries("Testset")
@@ -1,17 +1,579 @@
+import os
 import pytest
-from src.wrftamer.plotting.load_and_prepare import (
+import pickle
+import numpy as np
+import pandas as pd
+import xarray as xr
+from wrfplotter.load_and_prepare import (
     load_obs_data,
     load_mod_data,
     load_all_mod_data,
     load_all_obs_data,
     prep_ts_data,
     prep_zt_data,
+    prep_all_zt_data,
+    aggregate_time,
     prep_profile_data,
     get_limits_and_labels,
-    prep_windrose_data
+    calc_limits,
+    prep_windrose_data,
+    TslistCache,
+    StationView,
+    calc_ensemble_statistics,
+    calc_interpolation_weights,
+    get_interpolation_weights,
+    interpolate_to_heights,
+    get_obs_profiles,
+    get_mod_profiles,
+    open_averaged_tslist,
+    tslist_cache,
+    calc_alignment_index,
+    use_density,
+    calc_obs_vs_mod_density,
+    get_windrose_bins,
+    calc_windrose_table,
+    calc_windrose_tables,
+    get_windrose_tables,
 )
-from src.wrftamer import create_mpl_plot, Profile, TimeSeries, Obs_vs_Mod, Histogram
-from src.wrftamer import create_hv_plot
+from wrfplotter.variable_index import get_variable_index
+from wrfplotter.statistics import calc_statistics
+from wrfplotter.scorecard import calc_scorecard, write_scorecard
+from wrfplotter.mpl_plots import create_mpl_plot, Profile, TimeSeries, Obs_vs_Mod, Histogram
+from wrfplotter.hv_plots import create_hv_plot, to_tidy, get_downsample
+
+
+def test_station_view():
+    data = xr.Dataset(
+        {"WSP": (("station_name", "time"), np.arange(6.0).reshape(3, 2))},
+        coords={"station_name": ["FINO1", "FINO2", "FINO3"]},
+    )
+    view = StationView(data.isel(station_name=[0, 2]))
+
+    assert list(view) == ["FINO1", "FINO3"]
+    assert list(view["FINO3"].WSP.values) == [4.0, 5.0]
+    with pytest.raises(KeyError):
+        view["FINO2"]
+
+
+def test_tslist_cache():
+    cache = TslistCache(maxbytes=2 * 8 * 100)
+    datasets = [xr.Dataset({"WSP": ("time", np.zeros(100))}) for _ in range(0, 3)]
+
+    cache.put(("proj", "exp1", "d01", "raw_tslist", 1), datasets[0], ["FINO"])
+    cache.put(("proj", "exp2", "d01", "raw_tslist", 1), datasets[1], ["FINO"])
+    assert cache.get(("proj", "exp1", "d01", "raw_tslist", 1))[1] == ["FINO"]
+
+    # exp2 is the least recently used entry and is evicted.
+    cache.put(("proj", "exp3", "d01", "raw_tslist", 1), datasets[2], ["FINO"])
+    assert cache.get(("proj", "exp2", "d01", "raw_tslist", 1)) is None
+
+    # a new version of a file replaces the old one.
+    cache.put(("proj", "exp1", "d01", "raw_tslist", 2), datasets[0], ["FINO"])
+    assert cache.get(("proj", "exp1", "d01", "raw_tslist", 1)) is None
+    assert cache.info() == {"hits": 1, "misses": 2, "entries": 2, "nbytes": 2 * 8 * 100}
+
+
+def test_calc_ensemble_statistics():
+    tvec = np.arange("2020-01-01T00", "2020-01-01T04", dtype="datetime64[h]")
+    all_xa = []
+    for ii in range(0, 5):
+        all_xa.append(xr.Dataset({"WSP": ("time", np.full(4, float(ii)))}, coords={"time": tvec}).chunk())
+    all_xa[1] = all_xa[1].isel(time=slice(0, 3))  # missing time steps are NaN in the ensemble
+
+    data = xr.concat(all_xa, dim="experiment", join="outer")
+    stats = calc_ensemble_statistics(data, "WSP", percentiles=(0, 50, 100)).compute()
+
+    assert list(stats["mean"].values) == [2.0, 2.0, 2.0, 2.25]
+    assert list(stats["percentiles"].sel(percentile=100).values) == [4.0, 4.0, 4.0, 4.0]
+    assert list(stats["percentiles"].sel(percentile=0).values) == [0.0, 0.0, 0.0, 0.0]
+    np.testing.assert_allclose(stats["spread"].values[0], np.std([0, 1, 2, 3, 4]))
+
+
+def test_interpolate_to_heights():
+    zvec = np.array([[10.0, 50.0, 100.0], [20.0, 60.0, 120.0]])  # ALT changes with time
+
+    idx, w = calc_interpolation_weights(zvec, [5, 30, 100, 200])
+    assert idx.tolist() == [[0, 0, 1, 1], [0, 0, 1, 1]]
+    np.testing.assert_allclose(w, [[0.0, 0.5, 1.0, 1.0], [0.0, 0.25, 2.0 / 3.0, 1.0]])
+
+    data = xr.Dataset(
+        {
+            "ALT": (("time", "model_level"), zvec),
+            "WSP": (("time", "model_level"), zvec / 10.0, {"units": "m s-1"}),
+            "PRES": (("time", "model_level"), zvec * 0.0),
+        },
+        coords={"time": np.arange("2020-01-01T00", "2020-01-01T02", dtype="datetime64[h]")},
+    )
+    interp = interpolate_to_heights(data, ["WSP"], [30, 120], key=("exp", "FINO1"))
+
+    assert "PRES" not in interp
+    assert interp["WSP"].attrs["units"] == "m s-1"
+    np.testing.assert_allclose(interp["WSP"].values, [[3.0, 10.0], [3.0, 12.0]])
+
+    # cached by the memory of ALT, so the same column is served again and new data with the same key is not
+    weights = get_interpolation_weights(data["ALT"], [30, 120], key=("exp", "FINO1"))
+    assert get_interpolation_weights(data["ALT"], [30, 120], key=("exp", "FINO1")) is weights
+    shifted = data.assign(ALT=data["ALT"] + 10.0)
+    interp = interpolate_to_heights(shifted, ["WSP"], [30, 120], key=("exp", "FINO1"))
+    np.testing.assert_allclose(interp["WSP"].values, [[2.0, 10.0], [2.0, 11.0]])
+
+
+def test_prep_ts_data():
+    tvec = np.arange("2020-01-01T00", "2020-01-01T06", dtype="datetime64[h]")
+    obs = xr.Dataset(
+        {
+            "WSP_USA_40": ("time", np.arange(6.0), {"units": "m s-1"}),
+            "T_40": ("time", np.zeros(6), {"units": "K"}),
+        },
+        coords={"time": tvec},
+    )
+    zvec = np.tile([20.0, 60.0], (4, 1))
+    mod = xr.Dataset(
+        {
+            "ALT": (("time", "model_level"), zvec),
+            "WSP": (("time", "model_level"), zvec / 10.0, {"units": "m s-1", "standard_name": "wind_speed"}),
+        },
+        coords={"time": tvec[1:5]},
+    )
+    infos = {"anemometer": "Sonic", "loc": "FINO1", "Expvec": ["exp1"], "Obsvec": ["FINO1"], "var": "WSP", "lev": 40}
+
+    data, units, description = prep_ts_data({"FINO1": obs}, {"exp1": {"FINO1": mod}}, infos)
+
+    assert list(data.columns) == ["FINO1", "exp1"]
+    assert list(data.index) == list(tvec[1:5])  # observations are limited to the model period
+    assert list(data["FINO1"]) == [1.0, 2.0, 3.0, 4.0]
+    assert list(data["exp1"]) == [4.0, 4.0, 4.0, 4.0]
+    assert units == "m s-1" and description == "wind_speed"
+
+    # observations labeled 5 min later than the model are aligned to the model time axis.
+    obs = obs.assign_coords(time=tvec + np.timedelta64(5, "m"))
+    infos["align_tolerance"] = "10min"
+    infos["obs_offset"] = "-5min"
+    data, units, description = prep_ts_data({"FINO1": obs}, {"exp1": {"FINO1": mod}}, infos)
+    assert list(data.index) == list(tvec[1:5])
+    assert list(data["FINO1"]) == [1.0, 2.0, 3.0, 4.0]
+
+
+def test_calc_alignment_index():
+    source = np.array(["2020-01-01T00:00", "2020-01-01T00:10", "2020-01-01T00:20"], dtype="datetime64[m]")
+    target = np.array(["2020-01-01T00:04", "2020-01-01T00:06", "2020-01-01T00:40"], dtype="datetime64[m]")
+
+    idx, valid = calc_alignment_index(source, target)
+    assert idx.tolist() == [0, 1, 2] and valid.tolist() == [True, True, True]
+
+    idx, valid = calc_alignment_index(source, target, tolerance="5min")
+    assert valid.tolist() == [True, True, False]
+
+    idx, valid = calc_alignment_index(source, target, direction="backward")
+    assert idx.tolist() == [0, 0, 2]
+
+    idx, valid = calc_alignment_index(source, target, direction="forward")
+    assert idx.tolist()[:2] == [1, 1] and valid.tolist() == [True, True, False]
+
+
+def test_variable_index():
+    names = ["WSP_USA_100", "WSP_USA_40", "WSP_CUP_100", "WSP_USA_100_std", "DIR_VANE_92", "DIR_VANE_33", "T_10", "lat"]
+    data = xr.Dataset({name: ("time", np.zeros(2), {"units": "m s-1"}) for name in names})
+    index = get_variable_index(data)
+
+    assert index is get_variable_index(data.isel(time=[0]))  # same schema, same index
+    assert get_variable_index(data[["T_10"]]).heights("WSP", "USA").size == 0  # a subset is indexed by itself
+    data["T_20"] = ("time", np.zeros(2))
+    assert list(get_variable_index(data).heights("T")) == [10.0, 20.0]
+    pickle.loads(pickle.dumps(data))  # the index is not stored in the dataset
+    assert list(index.heights("WSP", "USA")) == [40.0, 100.0]
+    assert list(index.heights("WSP", "USA", "std")) == [100.0]
+    assert index.name("T", "", "10") == "T_10"
+    assert index.closest("DIR", "VANE", 100) == ("DIR_VANE_92", 92.0)
+    assert index.units["WSP_CUP_100"] == "m s-1"
+    with pytest.raises(KeyError):
+        index.name("WSP", "USA", "sfc")
+
+
+def test_get_profiles():
+    tvec = np.arange("2020-01-01T00", "2020-01-01T04", dtype="datetime64[h]")
+    obs = xr.Dataset(
+        {
+            "WSP_USA_100": ("time", np.arange(4.0) + 1.0, {"units": "m s-1"}),
+            "WSP_USA_40": ("time", np.arange(4.0), {"units": "m s-1"}),
+        },
+        coords={"time": tvec},
+    )
+    mod = xr.Dataset(
+        {
+            "ALT": (("time", "model_level"), np.tile([20.0, 60.0], (4, 1))),
+            "WSP": (("time", "model_level"), np.ones((4, 2))),
+        },
+        coords={"time": tvec},
+    )
+
+    profiles = get_obs_profiles(obs, "WSP", "USA", tvec[1:3])
+    assert list(profiles["height"].values) == [40.0, 100.0]
+    assert profiles.values.tolist() == [[1.0, 2.0], [2.0, 3.0]]
+
+    # nearest time step within the tolerance
+    profiles = get_obs_profiles(obs, "WSP", "USA", [tvec[1] + np.timedelta64(5, "m")], tolerance="10min")
+    assert profiles.values.tolist() == [[1.0, 2.0]]
+    with pytest.raises(IndexError):
+        get_obs_profiles(obs, "WSP", "USA", [tvec[1] + np.timedelta64(5, "m")])
+
+    profiles = get_mod_profiles(mod, "WSP", tvec)
+    assert profiles.dims == ("time", "model_level")
+    assert list(profiles["ALT"].mean("time").values) == [20.0, 60.0]
+
+
+def test_prep_windrose_data():
+    tvec = np.arange("2020-01-01T00", "2020-01-01T04", dtype="datetime64[h]")
+    names = ["WSP_USA_40", "WSP_USA_100", "DIR_USA_33", "DIR_USA_92"]
+    obs = xr.Dataset(
+        {name: ("time", np.arange(4.0) + ii, {"units": "m s-1"}) for ii, name in enumerate(names)},
+        coords={"time": tvec},
+    )
+    zvec = np.tile([20.0, 60.0], (4, 1))
+    mod = xr.Dataset(
+        {
+            "ALT": (("time", "model_level"), zvec),
+            "WSP": (("time", "model_level"), zvec / 10.0),
+            "DIR": (("time", "model_level"), np.zeros((4, 2)), {"units": "degree"}),
+            "U": (("time", "model_level"), np.ones((4, 2))),
+            "V": (("time", "model_level"), np.zeros((4, 2))),
+        },
+        coords={"time": tvec},
+    ).isel(time=slice(1, None))
+    infos = {"anemometer": "Sonic", "loc": "FINO1", "Expvec": ["exp1"], "Obsvec": ["FINO1"], "lev": 100}
+
+    (wsp_data, dir_data, tables), units, description = prep_windrose_data(
+        {"FINO1": obs}, {"exp1": {"FINO1": mod}}, infos
+    )
+
+    assert list(wsp_data.columns) == list(dir_data.columns) == ["FINO1", "exp1"]
+    assert list(wsp_data["FINO1"]) == [2.0, 3.0, 4.0]
+    assert list(dir_data["FINO1"]) == [4.0, 5.0, 6.0]  # closest level (92 m)
+    assert list(dir_data["exp1"]) == [270.0, 270.0, 270.0]  # from the interpolated U and V
+
+    assert list(tables.column.values) == ["FINO1", "exp1"]
+    np.testing.assert_allclose(tables.sum(dim=["speed", "sector"]), 100)
+    assert tables.sel(column="exp1", sector=270).sum() == 100
+
+
+def test_prep_zt_data():
+    tvec = np.arange("2020-01-01T00:00", "2020-01-01T08:00", 10, dtype="datetime64[m]")
+    zvec = np.tile([20.0, 60.0, 120.0], (len(tvec), 1)) + np.arange(len(tvec))[:, None]
+    mod = xr.Dataset(
+        {
+            "ALT": (("time", "model_level"), zvec, {"units": "m"}),
+            "WSP": (("time", "model_level"), zvec / 10.0),
+            "T": (("time", "model_level"), zvec),
+        },
+        coords={"time": tvec},
+    ).chunk()
+    mod_data = {"exp1": {"FINO1": mod}, "exp2": {"FINO1": mod}}
+    infos = {"loc": "FINO1", "var": "WSP", "Expvec": ["exp2"], "zt_from_to": (tvec[6], tvec[11])}
+
+    data = prep_zt_data(mod_data, infos)
+    assert data.chunks is not None  # still lazy
+    assert data.sizes["time"] == 6
+    assert list(data["ALT"].values) == [28.5, 68.5, 128.5]  # mean over the time window only
+
+    infos["zt_heights"] = "exact"
+    all_data = prep_all_zt_data(mod_data, infos, variables=["WSP", "T"])
+    assert list(all_data) == ["exp1", "exp2"]
+    assert all_data["exp1"]["T"].dims == ("time", "model_level")
+    assert all_data["exp1"]["ALT"].dims == ("time", "model_level")
+
+
+class _StubProject:
+    """A project with a single work directory for all experiments."""
+
+    def __init__(self, workdir, list_of_locs):
+        self.workdir = workdir
+        self.list_of_locs = list_of_locs
+
+    def get_workdir(self, exp_name):
+        return self.workdir
+
+    def exp_list_tslocs(self, exp_name, verbose=False):
+        return list(self.list_of_locs)
+
+
+def test_open_averaged_tslist(tmp_path, monkeypatch):
+    import wrfplotter.load_and_prepare as load_and_prepare
+
+    tslist_cache.clear()
+    monkeypatch.setattr(load_and_prepare, "_get_project", lambda proj_name: _StubProject(tmp_path, ["FINO1"]))
+
+    tvec = np.arange("2020-01-01T00:10", "2020-01-01T02:10", 10, dtype="datetime64[m]").astype("datetime64[ns]")
+    raw = xr.Dataset(
+        {
+            "WSP": (("time", "station_name"), np.arange(12.0)[:, None]),
+            "DIR": (("time", "station_name"), np.tile([350.0, 10.0, 0.0], 4)[:, None]),
+        },
+        coords={"time": tvec, "station_name": ["FINO1"]},
+    )
+    os.mkdir(tmp_path / "out")
+    raw_file = tmp_path / "out/raw_tslist_d01.nc"
+    raw.to_netcdf(raw_file)
+
+    data, list_of_locs, cache_file = open_averaged_tslist("proj", "exp1", "d01", 30)
+    assert cache_file == tmp_path / "out/Ave30Min_tslist_cache_d01.nc"
+    assert list(data["WSP"].values[:, 0]) == [1.0, 4.0, 7.0, 10.0]
+    assert data.indexes["time"][0] == pd.Timestamp("2020-01-01T00:30")  # labeled with the end, like ppp
+    np.testing.assert_allclose(np.mod(data["DIR"].values[:, 0] + 180, 360) - 180, 0, atol=1e-8)  # circular mean
+
+    # the cache is reused ...
+    mtime = cache_file.stat().st_mtime_ns
+    open_averaged_tslist("proj", "exp1", "d01", 30)
+    assert cache_file.stat().st_mtime_ns == mtime
+
+    # ... until the raw tslist changes.
+    (raw * 2).to_netcdf(tmp_path / "new_raw_tslist_d01.nc")
+    os.replace(tmp_path / "new_raw_tslist_d01.nc", raw_file)
+    data, list_of_locs, cache_file = open_averaged_tslist("proj", "exp1", "d01", 30)
+    assert list(data["WSP"].values[:, 0]) == [2.0, 8.0, 14.0, 20.0]
+
+    # the locations are cached with the dataset and read again if the file changes.
+    project = _StubProject(tmp_path, ["FINO1"])
+    monkeypatch.setattr(load_and_prepare, "_get_project", lambda proj_name: project)
+    project.list_of_locs = ["FINO1", "FINO2"]
+    assert open_averaged_tslist("proj", "exp1", "d01", "raw")[1] == ["FINO1"]
+    raw.to_netcdf(tmp_path / "new_raw_tslist_d01.nc")
+    os.replace(tmp_path / "new_raw_tslist_d01.nc", raw_file)
+    assert open_averaged_tslist("proj", "exp1", "d01", "raw")[1] == ["FINO1", "FINO2"]
+
+    monkeypatch.undo()
+    tslist_cache.clear()
+
+
+def test_calc_obs_vs_mod_density():
+    obs = np.array([1.0, 2.0, 3.0, 4.0, np.nan])
+    data = pd.DataFrame({"OBS": obs, "exp1": obs + 1, "exp2": [np.nan, 2.0, 3.0, 4.0, 5.0]})
+
+    assert not use_density(data)
+    assert use_density(data, threshold=5)
+    assert use_density(data, density=True)
+    assert not use_density(data, density=False, threshold=0)
+
+    density = calc_obs_vs_mod_density(data, bins=6, lims=(0, 6), quantiles=[0.0, 1.0])
+    np.testing.assert_allclose(density["edges"], np.arange(7))
+    assert density["counts"]["exp1"].sum() == 4
+    assert density["counts"]["exp2"].sum() == 3
+    assert density["counts"]["exp1"][1, 2] == 1  # obs 1, model 2
+    np.testing.assert_allclose(density["qq"]["exp1"][0], [1, 4])
+    np.testing.assert_allclose(density["qq"]["exp1"][1], [2, 5])
+    np.testing.assert_allclose(density["qq"]["exp2"][0], [2, 4])
+
+
+def test_calc_windrose_table():
+    np.testing.assert_allclose(get_windrose_bins(19.0), np.arange(0, 21, 2))
+    np.testing.assert_allclose(get_windrose_bins(np.nan), [0, 1])
+
+    wsp = np.array([0.5, 1.5, 2.5, 5.0, 1.0, np.nan])
+    wdir = np.array([359.0, 5.0, 90.0, 180.0, np.nan, 0.0])
+
+    table = calc_windrose_table(wsp, wdir, [0, 1, 2], nsector=4, normed=False)
+    assert table.shape == (3, 4)
+    assert table.sum() == 4
+    assert table[0, 0] == 1  # 359 degree is north
+    assert table[1, 0] == 1
+    assert table[2, 1] == 1
+    assert table[2, 2] == 1  # the last bin is open
+
+    np.testing.assert_allclose(calc_windrose_table(wsp, wdir, [0, 1, 2], nsector=4).sum(), 100)
+
+    index = pd.date_range("2020-01-01", periods=6, freq="10min")
+    wsp_data = pd.DataFrame({"obs": wsp, "exp": wsp[::-1]}, index=index)
+    dir_data = pd.DataFrame({"obs": wdir, "exp": wdir[::-1]}, index=index)
+    tables = calc_windrose_tables(wsp_data, dir_data, [0, 1, 2], nsector=4)
+
+    assert tables.dims == ("column", "speed", "sector")
+    np.testing.assert_allclose(tables.sector, [0, 90, 180, 270])
+    np.testing.assert_allclose(tables.sel(column="obs"), table * 25)
+    np.testing.assert_allclose(tables.sel(column="exp"), table * 25)
+
+    # the tables are reused if their bins match wspmax, and binned again otherwise.
+    tables = get_windrose_tables(wsp_data, dir_data)
+    assert get_windrose_tables(wsp_data, dir_data, tables, wspmax=5.0) is tables
+    np.testing.assert_allclose(get_windrose_tables(wsp_data, dir_data, tables, wspmax=20.0).speed, np.arange(0, 22, 2))
+
+
+def test_hv_timeseries_downsampling():
+    index = pd.date_range("2020-01-01", periods=6000, freq="10min", name="time")
+    data = pd.DataFrame({"obs": np.arange(6000.0), "exp": np.arange(6000.0) + 1}, index=index)
+    data.iloc[0, 0] = np.nan
+
+    tidy = to_tidy(data, "WSP")
+    assert list(tidy.columns) == ["time", "data", "WSP"]
+    assert len(tidy) == 11999
+    assert list(tidy["data"].cat.categories) == ["obs", "exp"]
+
+    assert get_downsample(data) == "lttb"
+    assert get_downsample(data.iloc[:100]) is False
+    assert get_downsample(data.iloc[:100], True) == "lttb"
+    assert get_downsample(data, "nth") == "nth"
+
+    infos = {"plottype": "Timeseries", "var": "WSP", "Obsvec": ["obs"], "Expvec": ["exp"]}
+    infos["tlim"] = (index[0], index[-1])
+    figure, stats = create_hv_plot(infos, data=data)
+    assert stats.loc["exp", "N"] == 5999
+
+
+def test_calc_limits():
+    data = pd.DataFrame({"obs": [1.0, np.nan, 3.0], "exp": [-2.0, 0.0, 10.0]})
+
+    limits = calc_limits(data)
+    assert limits["min"] == -2 and limits["max"] == 10
+    limits = calc_limits([data["obs"], data["exp"]], percentiles=[0, 50, 100])
+    np.testing.assert_allclose(limits["percentiles"], [-2, 1, 10])
+
+    assert np.isnan(calc_limits(np.array([np.nan]))["max"])
+    assert np.isnan(calc_limits([])["min"])
+
+    lazy = xr.DataArray(np.arange(100.0).reshape(10, 10)).chunk(3)
+    limits = calc_limits(lazy)
+    assert limits["min"] == 0 and limits["max"] == 99
+    assert calc_limits(lazy) is limits  # cached by the name of the dask array
+
+    infos = get_limits_and_labels("Obs vs Mod", "WSP", data, units="m s-1", description="")
+    assert infos["xlim"] == [-2, 10]
+    infos = get_limits_and_labels("Obs vs Mod", "WSP", data, units="m s-1", description="", percentiles=[25, 75])
+    assert infos["xlim"] == [0, 3]
+
+
+def test_aggregate_time():
+    tvec = pd.date_range("2020-01-01", periods=10, freq="10min")
+    alt = np.tile([10.0, 20.0], (10, 1)) + np.arange(10)[:, None]
+    data = xr.DataArray(
+        np.arange(20.0).reshape(10, 2),
+        dims=("time", "model_level"),
+        coords={"time": tvec, "ALT": (("time", "model_level"), alt)},
+        attrs={"units": "m s-1"},
+    )
+
+    assert aggregate_time(data, 10) is data
+
+    mean = aggregate_time(data, 4)  # 3 time steps per bin, the last bin is incomplete
+    assert mean.sizes["time"] == 4
+    np.testing.assert_allclose(mean.values[0], [2, 3])
+    np.testing.assert_allclose(mean.values[-1], [18, 19])
+    np.testing.assert_allclose(mean["ALT"].values[0], [11, 21])
+    assert mean["time"].values[0] == tvec[1]
+    assert mean.attrs["units"] == "m s-1"
+
+    np.testing.assert_allclose(aggregate_time(data.chunk(), 4, how="max").values[0], [4, 5])
+
+    with pytest.raises(ValueError):
+        aggregate_time(data, 4, how="median")
+
+
+def test_calc_statistics():
+    obs = np.arange(10.0)
+    data = pd.DataFrame({"FINO1": obs, "exp1": obs + 1.0, "exp2": 2.0 * obs})
+    data.loc[3, "exp2"] = np.nan
+
+    stats = calc_statistics(data)
+    assert list(stats.index) == ["exp1", "exp2"]
+    assert list(stats["N"]) == [10, 9]
+    np.testing.assert_allclose(stats.loc["exp1", ["Bias", "MAE", "RMSE", "R", "Std Ratio"]], [1, 1, 1, 1, 1])
+    np.testing.assert_allclose(stats.loc["exp2", ["R", "Std Ratio"]], [1, 2])
+
+    # chunks of the table and lazy (dask) data give the same result
+    pd.testing.assert_frame_equal(calc_statistics(data, chunksize=3), stats)
+    lazy = xr.Dataset({name: ("time", data[name].values) for name in data.columns}).chunk(time=4)
+    pd.testing.assert_frame_equal(calc_statistics(lazy), stats)
+
+    # differences of directions are wrapped
+    data = pd.DataFrame({"FINO1": [350.0, 10.0], "exp1": [10.0, 350.0]})
+    stats = calc_statistics(data, var="DIR")
+    np.testing.assert_allclose(stats.loc["exp1", ["Bias", "MAE", "RMSE"]], [0, 20, 20])
+
+
+def test_calc_scorecard(tmp_path):
+    tvec = np.arange("2020-01-01T00", "2020-01-02T00", dtype="datetime64[h]")
+    obs_data = dict()
+    for ii, station in enumerate(["FINO1", "FINO2"]):
+        obs_data[station] = xr.Dataset(
+            {
+                "WSP_USA_40": ("time", np.arange(24.0)),
+                "WSP_USA_100": ("time", np.arange(24.0) + ii),
+                "T_10": ("time", np.zeros(24)),
+            },
+            coords={"time": tvec, "station_name": station, "lat": 54.0},
+        )
+
+    zvec = np.tile([20.0, 60.0, 140.0], (2, 24, 1))
+    mod_data = dict()
+    for ii, exp in enumerate(["exp1", "exp2"]):
+        mod = xr.Dataset(
+            {
+                "ALT": (("station_name", "time", "model_level"), zvec),
+                "WSP": (("station_name", "time", "model_level"), np.arange(24.0)[None, :, None] + zvec * 0 + ii),
+            },
+            coords={"time": tvec, "station_name": ["FINO1", "FINO2"], "lat": ("station_name", [54.1, 54.2])},
+        )
+        mod_data[exp] = StationView(mod)
+
+    table = calc_scorecard(obs_data, mod_data, variables=["WSP", "DIR"])
+
+    assert len(table) == 2 * 2 * 2  # stations x heights x experiments (no DIR)
+    row = table.query("station == 'FINO2' and height == 100 and experiment == 'exp1'").iloc[0]
+    assert row["N"] == 24
+    np.testing.assert_allclose([row["Bias"], row["R"]], [-1.0, 1.0])
+
+    write_scorecard(table, tmp_path / "scorecard.nc")
+    with xr.open_dataset(tmp_path / "scorecard.nc") as data:
+        assert list(data["experiment"].values[:2]) == ["exp1", "exp2"]
+
+
+def test_run_scorecard(tmp_path, monkeypatch):
+    import wrfplotter.load_and_prepare as load_and_prepare
+    from wrfplotter.wrfplotter_classes import Timeseries
+    from wrfplotter.scorecard import run_scorecard
+
+    monkeypatch.setenv("OBSERVATIONS_PATH", str(tmp_path))
+    tslist_cache.clear()
+    monkeypatch.setattr(load_and_prepare, "_get_project", lambda proj_name: _StubProject(tmp_path, ["FINO1"]))
+
+    # monthly files, the evaluated window spans both of them.
+    tvec = pd.date_range("2020-01-01", "2020-03-01", freq="h", inclusive="left")
+    obs = xr.Dataset(
+        {"WSP_USA_100": (("time", "station_name"), np.arange(len(tvec), dtype=float)[:, None])},
+        coords={"time": tvec, "station_name": ["FINO1"]},
+    )
+    Timeseries("Scoreset", data=obs).write_cfconform_data(split="MS")
+
+    # the model is 1 m/s too fast within the window and far off outside of it.
+    dtstart, dtend = pd.Timestamp("2020-01-15"), pd.Timestamp("2020-02-15")
+    wsp = obs.WSP_USA_100.values[:, 0] + np.where((tvec >= dtstart) & (tvec <= dtend), 1.0, 100.0)
+    zvec = np.tile([20.0, 60.0, 140.0], (1, len(tvec), 1))
+    mod = xr.Dataset(
+        {
+            "ALT": (("station_name", "time", "model_level"), zvec),
+            "WSP": (("station_name", "time", "model_level"), wsp[None, :, None] + zvec * 0),
+        },
+        coords={"time": tvec, "station_name": ["FINO1"]},
+    )
+    os.mkdir(tmp_path / "out")
+    mod.to_netcdf(tmp_path / "out/raw_tslist_d01.nc")
+
+    table = run_scorecard(
+        "proj",
+        ["exp1", "exp2"],
+        ["Scoreset"],
+        "d01",
+        dtstart,
+        dtend,
+        variables=["WSP"],
+        outfile=tmp_path / "scorecard.nc",
+        split="MS",
+    )
+
+    assert list(table["experiment"]) == ["exp1", "exp2"]
+    assert list(table["station"]) == ["FINO1", "FINO1"]
+    np.testing.assert_allclose(table["Bias"], 1.0)
+    assert (tmp_path / "scorecard.nc").is_file()
+
+    monkeypatch.undo()
+    tslist_cache.clear()
 
 
 # all fail